@@ -0,0 +1,280 @@
+'''A local stand-in for the parts of the Spotify Web API that Recentlier uses.
+
+The library is synthetic and generated on demand from a seed, so any number of followed
+artists can be served without holding the whole catalog in memory. Ids encode what they
+point to (ar000001, al000001x0003, tr000001x0003x007), which keeps every endpoint stateless
+apart from the playlists.'''
+import json
+import random
+import threading
+import time
+import zlib
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlencode, urlparse
+
+USER = 'bench'
+
+
+class Library:
+    '''Deterministic synthetic artists, albums and tracks'''
+
+    def __init__(self, artists: int, seed: int = 1) -> None:
+        self.artists = artists
+        self.seed = seed
+
+    def artist(self, index: int) -> dict:
+        return {'id': f'ar{index:06d}', 'name': f'Artist {index}', 'type': 'artist'}
+
+    def albums(self, artist: int) -> list:
+        '''Every album of an artist, newest first within each group like the real API'''
+        rnd = random.Random(self.seed * 1000003 + artist)
+        albums = []
+        for number in range(rnd.randint(1, 40)):
+            group = rnd.choices(('album', 'single', 'compilation', 'appears_on'), (4, 5, 1, 3))[0]
+            year = rnd.randint(1970, 2026)
+            day = (f'{year}-{rnd.randint(1, 12):02d}-{rnd.randint(1, 28):02d}', 'day')
+            release_date, precision = rnd.choice(((f'{year}', 'year'), (f'{year}-{rnd.randint(1, 12):02d}', 'month'), *[day] * 6))
+            albums.append(
+                {
+                    'id': f'al{artist:06d}x{number:04d}',
+                    'name': f'Album {number}' + (' (Live)' if rnd.random() < 0.05 else ''),
+                    'album_type': 'compilation' if group == 'compilation' else ('single' if group == 'single' else 'album'),
+                    'album_group': group,
+                    'release_date': release_date,
+                    'release_date_precision': precision,
+                    'total_tracks': rnd.choice((1, 2, 4, 10, 12, 14, 20, 60)) if group != 'single' else rnd.randint(1, 3),
+                    'artists': [self.artist(artist)],
+                }
+            )
+        order = {'album': 0, 'single': 1, 'appears_on': 2, 'compilation': 3}
+        albums.sort(key=lambda x: x['release_date'], reverse=True)
+        return sorted(albums, key=lambda x: order[x['album_group']])
+
+    def album(self, album_id: str) -> dict:
+        artist, number = (int(i) for i in album_id[2:].split('x'))
+        for album in self.albums(artist):
+            if album['id'] == album_id:
+                return album
+        raise KeyError(album_id)
+
+    def tracks(self, album: dict) -> list:
+        artist, number = (int(i) for i in album['id'][2:].split('x'))
+        rnd = random.Random(hash((self.seed, artist, number)) & 0xFFFFFFFF)
+        tracks = []
+        for index in range(album['total_tracks']):
+            artists = [self.artist(artist)]
+            if album['album_group'] == 'appears_on' or rnd.random() < 0.1:
+                # Features and compilations credit someone else first.
+                artists.insert(0, self.artist(rnd.randrange(self.artists * 2)))
+            tracks.append(
+                {
+                    'id': f'tr{artist:06d}x{number:04d}x{index:03d}',
+                    # Singles reuse album track names, so there are duplicates to resolve.
+                    'name': f'Song {artist}-{rnd.randint(0, 25)}' if rnd.random() < 0.3 else f'Song {album["id"]}-{index}',
+                    'duration_ms': rnd.randint(20000, 400000),
+                    'artists': artists,
+                }
+            )
+        return tracks
+
+
+class FakeSpotify(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, library: Library, latency: float = 0.0, throttle: float = 0.0, retry_after: int = 1):
+        super().__init__(address, Handler)
+        self.library = library
+        self.latency = latency
+        self.throttle = throttle
+        self.retry_after = retry_after
+        self.lock = threading.Lock()
+        self.requests: dict = {}
+        self.bytes = 0
+        self.playlists: dict = {}
+        self.random = random.Random(library.seed)
+
+    @property
+    def url(self) -> str:
+        return f'http://{self.server_address[0]}:{self.server_address[1]}/v1/'
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server: FakeSpotify
+
+    def log_message(self, *args) -> None:
+        pass
+
+    def do_GET(self) -> None:
+        self.handle_request('GET')
+
+    def do_POST(self) -> None:
+        self.handle_request('POST')
+
+    def do_PUT(self) -> None:
+        self.handle_request('PUT')
+
+    def do_DELETE(self) -> None:
+        self.handle_request('DELETE')
+
+    def reply(self, status: int, body=None, headers: dict = None) -> None:
+        data = json.dumps(body).encode() if body is not None else b''
+        headers = dict(headers or {})
+        if self.command == 'GET' and status == 200:
+            # Like the real API, a GET can be revalidated with the ETag it came with.
+            headers['ETag'] = f'"{zlib.crc32(data):08x}"'
+            if self.headers.get('If-None-Match') == headers['ETag']:
+                status, data = 304, b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+        with self.server.lock:
+            self.server.bytes += len(data)
+
+    def page(self, items: list, path: str, query: dict, default: int = 20) -> dict:
+        offset = int(query.get('offset', 0))
+        limit = int(query.get('limit', default))
+        following = f'{self.server.url}{path}?' + urlencode(dict(query, offset=offset + limit, limit=limit))
+        return {
+            'href': f'{self.server.url}{path}',
+            'items': items[offset : offset + limit],
+            'limit': limit,
+            'offset': offset,
+            'total': len(items),
+            'next': following if offset + limit < len(items) else None,
+        }
+
+    def handle_request(self, method: str) -> None:
+        url = urlparse(self.path)
+        query = {key: value[-1] for key, value in parse_qs(url.query).items()}
+        length = int(self.headers.get('Content-Length') or 0)
+        payload = json.loads(self.rfile.read(length)) if length else None
+        path = url.path.removeprefix('/v1/').strip('/')
+        parts = path.split('/')
+
+        if path == '_stats':
+            with self.server.lock:
+                data = {'requests': dict(self.server.requests), 'bytes': self.server.bytes}
+            return self.reply(200, data)
+
+        endpoint = f'{method} ' + '/'.join('{id}' if index % 2 and parts[0] != 'me' else i for index, i in enumerate(parts))
+        with self.server.lock:
+            self.server.requests[endpoint] = self.server.requests.get(endpoint, 0) + 1
+            throttled = self.server.random.random() < self.server.throttle
+
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if throttled:
+            return self.reply(429, {'error': {'status': 429, 'message': 'API rate limit exceeded'}},
+                              {'Retry-After': str(self.server.retry_after)})
+
+        try:
+            status, body = self.route(method, parts, query, payload)
+        except (KeyError, ValueError, IndexError) as R:
+            status, body = 404, {'error': {'status': 404, 'message': f'non existing id {R}'}}
+        self.reply(status, body)
+
+    def route(self, method: str, parts: list, query: dict, payload):
+        library = self.server.library
+        path = '/'.join(parts)
+
+        if parts == ['me']:
+            return 200, {'id': USER, 'display_name': USER}
+
+        if parts == ['me', 'following']:
+            after = int(query['after'][2:]) + 1 if query.get('after') else 0
+            limit = int(query.get('limit', 20))
+            items = [library.artist(i) for i in range(after, min(after + limit, library.artists))]
+            following = None
+            if after + limit < library.artists:
+                following = f'{self.server.url}me/following?' + urlencode(dict(query, after=items[-1]['id']))
+            return 200, {'artists': {'items': items, 'next': following, 'total': library.artists, 'limit': limit,
+                                     'cursors': {'after': items[-1]['id'] if items else None}}}
+
+        if parts[0] == 'artists' and parts[2:] == ['albums']:
+            albums = library.albums(int(parts[1][2:]))
+            if groups := query.get('include_groups'):
+                albums = [i for i in albums if i['album_group'] in groups.split(',')]
+            return 200, self.page(albums, path, query)
+
+        if parts == ['albums']:
+            albums = []
+            for album_id in query['ids'].split(',')[:20]:
+                album = dict(library.album(album_id))
+                album['tracks'] = self.page(library.tracks(album), f'albums/{album_id}/tracks', {'limit': 50})
+                albums.append(album)
+            return 200, {'albums': albums}
+
+        if parts[0] == 'albums' and parts[2:] == ['tracks']:
+            return 200, self.page(library.tracks(library.album(parts[1])), path, query)
+
+        if parts[0] == 'users' and parts[2:] == ['playlists'] or parts == ['me', 'playlists']:
+            if method == 'POST':
+                playlist_id = f'pl{len(self.server.playlists):06d}'
+                self.server.playlists[playlist_id] = {'name': payload['name'], 'items': [], 'snapshot': 0}
+                return 201, self.playlist(playlist_id)
+            return 200, self.page([self.playlist(i) for i in self.server.playlists], path, query, 50)
+
+        if parts[0] == 'users' and parts[2] == 'playlists':
+            parts = parts[2:]
+
+        if parts[0] == 'playlists' and len(parts) == 2:
+            if method == 'PUT':
+                self.server.playlists[parts[1]].update(payload)
+                return 200, None
+            return 200, self.playlist(parts[1])
+
+        if parts[0] == 'playlists' and parts[2] in ('tracks', 'items'):
+            return self.playlist_items(method, parts[1], path, query, payload)
+
+        return 404, {'error': {'status': 404, 'message': f'unknown endpoint {path}'}}
+
+    def playlist(self, playlist_id: str) -> dict:
+        playlist = self.server.playlists[playlist_id]
+        return {
+            'id': playlist_id,
+            'name': playlist['name'],
+            'owner': {'id': USER, 'display_name': USER},
+            'snapshot_id': str(playlist['snapshot']),
+            'tracks': {'href': f'{self.server.url}playlists/{playlist_id}/tracks', 'total': len(playlist['items'])},
+        }
+
+    def playlist_items(self, method: str, playlist_id: str, path: str, query: dict, payload):
+        playlist = self.server.playlists[playlist_id]
+        items = playlist['items']
+
+        if method == 'GET':
+            return 200, self.page([{'track': {'id': i}} for i in items], path, query, 100)
+
+        ids = lambda uris: [i.split(':')[-1] for i in uris]  # noqa: E731
+        if method == 'POST':
+            uris = payload if isinstance(payload, list) else payload['uris']
+            position = int(query.get('position', len(items)))
+            items[position:position] = ids(uris)
+        elif method == 'DELETE':
+            remove = set(ids(i['uri'] for i in payload.get('items', payload.get('tracks', []))))
+            items[:] = [i for i in items if i not in remove]
+        elif 'uris' in payload:
+            items[:] = ids(payload['uris'])
+        else:
+            start, length, before = payload['range_start'], payload.get('range_length', 1), payload['insert_before']
+            moved = items[start : start + length]
+            rest = items[:start] + [None] * length + items[start + length :]
+            rest[before:before] = moved
+            items[:] = [i for i in rest if i is not None]
+
+        playlist['snapshot'] += 1
+        return 201 if method == 'POST' else 200, {'snapshot_id': str(playlist['snapshot'])}
+
+
+def serve(artists: int, seed: int, latency: float, throttle: float, retry_after: int, port: int = 0, ready=None) -> None:
+    '''Runs the fake API until the process is terminated, sends the bound port to `ready`'''
+    server = FakeSpotify(('127.0.0.1', port), Library(artists, seed), latency, throttle, retry_after)
+    if ready is not None:
+        ready.send(server.server_address[1])
+    server.serve_forever()
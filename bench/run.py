@@ -0,0 +1,200 @@
+'''Runs the crawl end to end against bench.fakeapi and reports what every phase costs.
+
+    python -m bench.run --artists 100 1000 10000 --latency 0.05 --throttle 0.01
+
+Every library size gets its own fake API process and its own crawl process, so wall-clock,
+CPU time and peak memory are those of the crawl alone. Requests and bytes are counted by
+the fake API. Peak memory comes from tracemalloc, which slows the crawl down, so use
+--no-memory when comparing CPU time. --save writes the results as json, --compare fails (exit 1) when a phase got
+slower or needs more requests than in a saved run.'''
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from urllib.request import urlopen
+
+from bench.fakeapi import serve
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def config(args) -> dict:
+    return {
+        'username': 'bench',
+        'spotify': {'client_id': 'bench', 'client_secret': 'bench', 'scope': [], 'callback': 'http://127.0.0.1:8081'},
+        'playlist': {'name': 'Recentlier2', 'size': args.playlist_size, 'id': None},
+        'output': {'on': True, 'verbose': False},
+        'application': {
+            'quit_after_update': True,
+            'concurrency': args.concurrency,
+            'rate_limit': args.rate_limit,
+            'version_check': False,
+        },
+    }
+
+
+def stats(url: str) -> dict:
+    with urlopen(f'{url}_stats') as response:
+        data = json.load(response)
+    return {'requests': sum(data['requests'].values()), 'bytes': data['bytes'], 'endpoints': data['requests']}
+
+
+async def crawl(url: str, args) -> list:
+    sys.path.insert(0, ROOT)
+    from recentlier import main
+    from recentlier.spotify import Spotify
+
+    # No OAuth, the fake API takes any token.
+    Spotify.prefix = url
+    Spotify.token = 'bench'
+
+    recentlier = main.Recentlier()
+    recentlier.playlist.playlist = await recentlier.playlist.get_playlist()
+
+    async def persist() -> None:
+        await recentlier.cache.write()
+        await recentlier.cache.flush()
+
+    phases = (
+        ('artists', recentlier.populate_artists, (), 'Artists'),
+        ('albums', recentlier.populate_albums, lambda: (recentlier.Artists,), 'Albums'),
+        ('tracks', recentlier.populate_tracks, lambda: (recentlier.Albums,), 'Tracks'),
+        ('update', recentlier.playlist.update, (), None),
+        ('cache', persist, (), None),
+    )
+
+    results = []
+    if args.memory:
+        tracemalloc.start()
+    for name, phase, arguments, attribute in phases:
+        before = stats(url)
+        tracemalloc.reset_peak()
+        wall, cpu = time.perf_counter(), time.process_time()
+
+        data = await phase(*(arguments() if callable(arguments) else arguments))
+
+        wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+        peak = tracemalloc.get_traced_memory()[1] if args.memory else 0
+        after = stats(url)
+        if attribute:
+            setattr(recentlier, attribute, data)
+
+        results.append(
+            {
+                'phase': name,
+                'wall': wall,
+                'cpu': cpu,
+                'requests': after['requests'] - before['requests'],
+                'bytes': after['bytes'] - before['bytes'],
+                'peak_memory': peak,
+                'objects': len(data) if attribute else None,
+            }
+        )
+    tracemalloc.stop()
+    return results
+
+
+def worker(url: str, args, directory: str, pipe) -> None:
+    '''Runs one crawl in a scratch directory with a fresh config.json'''
+    os.chdir(directory)
+    with open('config.json', 'w') as handle:
+        json.dump(config(args), handle)
+    if not args.verbose:
+        sys.stdout = open(os.devnull, 'w')
+        logging.getLogger('spotipy').setLevel(logging.CRITICAL)
+    pipe.send(asyncio.run(crawl(url, args)))
+
+
+def run(artists: int, args) -> list:
+    context = multiprocessing.get_context('spawn')
+    ready, port = context.Pipe()
+    server = context.Process(
+        target=serve,
+        args=(artists, args.seed, args.latency, args.throttle, args.retry_after),
+        kwargs={'ready': ready},
+        daemon=True,
+    )
+    server.start()
+    url = f'http://127.0.0.1:{port.recv()}/v1/'
+
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            receive, send = context.Pipe(duplex=False)
+            crawler = context.Process(target=worker, args=(url, args, directory, send))
+            crawler.start()
+            while not receive.poll(1):
+                if not crawler.is_alive():
+                    raise RuntimeError(f'The crawl for {artists} artists failed, rerun with --verbose to see why.')
+            results = receive.recv()
+            crawler.join()
+    finally:
+        server.terminate()
+    return results
+
+
+def report(artists: int, results: list) -> None:
+    print(f'\n{artists} artists')
+    print(f'{"phase":<10}{"wall s":>10}{"cpu s":>10}{"requests":>10}{"MB recv":>10}{"peak MB":>10}{"objects":>10}')
+    for i in results:
+        print(
+            f'{i["phase"]:<10}{i["wall"]:>10.2f}{i["cpu"]:>10.2f}{i["requests"]:>10}'
+            f'{i["bytes"] / 1e6:>10.2f}{i["peak_memory"] / 1e6:>10.1f}{i["objects"] if i["objects"] is not None else "":>10}'
+        )
+
+
+def regressions(results: dict, baseline: dict, tolerance: float) -> list:
+    found = []
+    for artists, phases in results.items():
+        old = {i['phase']: i for i in baseline.get(artists, [])}
+        for i in phases:
+            if i['phase'] not in old:
+                continue
+            for key in ('wall', 'requests'):
+                if i[key] > old[i['phase']][key] * (1 + tolerance) and i[key] - old[i['phase']][key] > 0.05:
+                    found.append(f'{artists} artists, {i["phase"]}: {key} {old[i["phase"]][key]:.2f} -> {i[key]:.2f}')
+    return found
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Benchmark the Recentlier crawl against a local fake Spotify API.')
+    parser.add_argument('--artists', type=int, nargs='+', default=[100], help='followed artists, one run per size')
+    parser.add_argument('--latency', type=float, default=0.02, help='seconds added to every response')
+    parser.add_argument('--throttle', type=float, default=0.0, help='fraction of requests answered with a 429')
+    parser.add_argument('--retry-after', type=int, default=1, help='Retry-After sent with every 429')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--rate-limit', type=float, default=1000, help='application.rate_limit for the crawl')
+    parser.add_argument('--playlist-size', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--save', help='write the results to this json file')
+    parser.add_argument('--compare', help='fail if slower than the results in this json file')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed slowdown for --compare')
+    parser.add_argument('--no-memory', dest='memory', action='store_false', help='dont trace memory, for accurate CPU time')
+    parser.add_argument('--verbose', action='store_true', help='show the output of the crawl')
+    args = parser.parse_args()
+
+    results = {}
+    for artists in args.artists:
+        results[str(artists)] = run(artists, args)
+        report(artists, results[str(artists)])
+
+    if args.save:
+        with open(args.save, 'w') as handle:
+            json.dump(results, handle, indent=2)
+
+    if args.compare:
+        with open(args.compare) as handle:
+            found = regressions(results, json.load(handle), args.tolerance)
+        for i in found:
+            print(f'Regression: {i}')
+        sys.exit(1 if found else 0)
+
+
+if __name__ == '__main__':
+    main()
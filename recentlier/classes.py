@@ -1,43 +1,176 @@
-from dataclasses import dataclass
+import heapq
+import re
 
+from dataclasses import dataclass, field
+from itertools import chain
 
-@dataclass(order=True)
+
+# How much of a release date Spotify knows, a higher precision is more exact.
+YEAR, MONTH, DAY = 1, 2, 3
+PRECISIONS = {'year': YEAR, 'month': MONTH, 'day': DAY}
+
+
+def date_key(release_date: str) -> int:
+    '''"2021-03-09" -> 20210309, parsed once when an album or track comes in.
+
+    A missing month or day counts as 00 ("2021" -> 20210000), so a year or month precision
+    date sorts before every day precision date in the same year or month, and the key
+    still tells which precision it was made from.'''
+    if not release_date:
+        return 0
+    year, month, day = (release_date.split('-') + ['0', '0'])[:3]
+    return int(year) * 10000 + int(month) * 100 + int(day)
+
+
+def date_precision(key: int) -> int:
+    if not key // 100 % 100:
+        return YEAR
+    if not key % 100:
+        return MONTH
+    return DAY
+
+
+def date_string(key: int) -> str:
+    '''The release date a date_key() was made from'''
+    year, month, day = key // 10000, key // 100 % 100, key % 100
+    precision = date_precision(key)
+    if precision == YEAR:
+        return f'{year:04d}'
+    if precision == MONTH:
+        return f'{year:04d}-{month:02d}'
+    return f'{year:04d}-{month:02d}-{day:02d}'
+
+
+@dataclass(slots=True)
+class Artist:
+    id: str
+    name: str
+
+    def __eq__(self, id):
+        return self.id == id
+
+    @classmethod
+    def create(cls, id: str, name: str) -> 'Artist':
+        '''The one Artist object for this id, so albums and tracks all share it'''
+        artist = known.get(id)
+        if artist is None:
+            artist = known[id] = cls(id, name)
+        elif artist.name != name:
+            artist.name = name
+        return artist
+
+    def __reduce__(self):
+        return (Artist.create, (self.id, self.name))
+
+    def __setstate__(self, state):
+        # Caches written before Artist had slots.
+        self.id, self.name = state['id'], state['name']
+        known.setdefault(self.id, self)
+
+
+# artist id -> Artist, every Artist made by Artist.create()
+known: dict = {}
+
+
+@dataclass(order=True, slots=True)
 class Track:
     id: str
     name: str
-    release_date: str
+    date: int
     duration: int
-    artist_id: str
-    artist_name: str
+    artist: Artist = field(compare=False)
+    # The album the track was fetched from, so it can be pruned with it.
+    album_id: str = field(default=None, compare=False)
+    # The ids of every artist credited on the track if there is more than one, `artist` is the first of them we follow.
+    credits: tuple = field(default=(), compare=False)
+
+    @classmethod
+    def create(cls, id, name, release_date, duration, artist_id, artist_name, album_id=None, artist_ids=None) -> 'Track':
+        credits = tuple(artist_ids.split(',')) if artist_ids else ()
+        return cls(id, name, date_key(release_date), duration, Artist.create(artist_id, artist_name), album_id, credits)
+
+    @property
+    def release_date(self) -> str:
+        return date_string(self.date)
 
-    def __post_init__(self):
-        '''enables comparison and sorting'''
-        object.__setattr__(self, 'release_date', self.release_date)
+    @property
+    def precision(self) -> int:
+        return date_precision(self.date)
+
+    @property
+    def artist_id(self) -> str:
+        return self.artist.id
+
+    @property
+    def artist_name(self) -> str:
+        return self.artist.name
+
+    @property
+    def artist_ids(self) -> str:
+        return ','.join(self.credits)
+
+    @property
+    def artists(self) -> tuple:
+        '''Every artist id the track is credited to'''
+        return self.credits or (self.artist.id,)
 
     def __eq__(self, _id):
-        return self.id == _id or f'{self.artist_name} - {self.name}' == _id
+        return self.id == _id or f'{self.artist.name} - {self.name}' == _id
 
+    def __getstate__(self):
+        return (self.id, self.name, self.date, self.duration, self.artist, self.album_id, self.credits)
 
-@dataclass
+    def __setstate__(self, state):
+        if isinstance(state, dict):
+            # Caches written before Track had slots.
+            state = Track.create(**state).__getstate__()
+        # Caches written before tracks knew their album or credits have neither.
+        self.id, self.name, self.date, self.duration, self.artist, self.album_id, self.credits = (tuple(state) + (None, ()))[:7]
+
+
+@dataclass(slots=True)
 class Album:
-    release_date: str
     id: str
     name: str
-    artist_name: str
-    artist_id: str
+    date: int
+    artist: Artist
 
-    def __eq__(self, id):
-        return self.id == id
+    @classmethod
+    def create(cls, id, name, release_date, artist_id, artist_name) -> 'Album':
+        return cls(id, name, date_key(release_date), Artist.create(artist_id, artist_name))
 
+    @property
+    def release_date(self) -> str:
+        return date_string(self.date)
 
-@dataclass
-class Artist:
-    id: str
-    name: str
+    @property
+    def precision(self) -> int:
+        return date_precision(self.date)
+
+    @property
+    def artist_id(self) -> str:
+        return self.artist.id
+
+    @property
+    def artist_name(self) -> str:
+        return self.artist.name
 
     def __eq__(self, id):
         return self.id == id
 
+    def fingerprint(self) -> tuple:
+        '''What the tracks of this album depend on, their tracks are fetched again when it changes'''
+        return (self.name, self.date, self.artist.id)
+
+    def __getstate__(self):
+        return (self.id, self.name, self.date, self.artist)
+
+    def __setstate__(self, state):
+        if isinstance(state, dict):
+            # Caches written before Album had slots.
+            state = Album.create(**state).__getstate__()
+        self.id, self.name, self.date, self.artist = state
+
 
 @dataclass
 class Playlist:
@@ -48,3 +181,164 @@ class Playlist:
 
     def __eq__(self, _in):
         return self.name == _in or self.id == _in
+
+
+class Index:
+    '''A list of Artists, Albums or Tracks that is also indexed on their id.
+
+    Iterates and len()s like the list it replaces, but `in` and lookups by id are O(1).
+    Appending an id that is already present keeps the first one, like the crawl did.'''
+
+    def __init__(self, items=()) -> None:
+        self.items: dict = {}
+        for item in items:
+            self.append(item)
+
+    def append(self, item) -> None:
+        self.items.setdefault(item.id, item)
+
+    def remove(self, _id: str) -> None:
+        self.items.pop(_id, None)
+
+    def get(self, _id: str, default=None):
+        return self.items.get(_id, default)
+
+    def ids(self):
+        '''A set-like view of every id'''
+        return self.items.keys()
+
+    def __contains__(self, _in) -> bool:
+        return getattr(_in, 'id', _in) in self.items
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return self.items[key]
+        return list(self.items.values())[key]
+
+    def __iter__(self):
+        return iter(self.items.values())
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    def __repr__(self) -> str:
+        return f'Index({list(self.items.values())!r})'
+
+
+class TrackIndex(Index):
+    '''An Index of Tracks that also keeps track of the newest ones.
+
+    Tracks are grouped under every artist credited on them, and once newest() has been asked
+    for n tracks a bounded min-heap of the n newest is kept up to date on every append, so
+    picking the playlist is O(log n) per new track instead of a full sort. Among equal release dates the track that
+    was appended last counts as the newest.'''
+
+    def __init__(self, items=()) -> None:
+        self.heap: list = []
+        self.size = 0
+        self.counter = 0
+        self.stale = False
+        # artist id -> [(date, counter, Track)]
+        self.artists: dict = {}
+        super().__init__(items)
+
+    def append(self, track) -> None:
+        if track.id in self.items:
+            return
+        super().append(track)
+        self.counter += 1
+        entry = (track.date, self.counter, track)
+        for artist_id in track.artists:
+            self.artists.setdefault(artist_id, []).append(entry)
+
+        if len(self.heap) < self.size:
+            heapq.heappush(self.heap, entry)
+        elif self.size and entry[:2] > self.heap[0][:2]:
+            heapq.heapreplace(self.heap, entry)
+
+    def remove(self, _id: str) -> None:
+        track = self.items.get(_id)
+        if track is None:
+            return
+        super().remove(_id)
+        for artist_id in track.artists:
+            self.artists[artist_id] = [i for i in self.artists[artist_id] if i[2] is not track]
+        self.stale = True
+
+    def newest(self, n: int, artists=None, precision: int = YEAR) -> list:
+        '''The `n` newest tracks, newest first. Limited to tracks by `artists` if given,
+        and to tracks with a release date of at least `precision`.'''
+        if artists is not None:
+            entries = self.unique(self.artists.get(getattr(i, 'id', i), ()) for i in artists)
+            return [i[2] for i in heapq.nlargest(n, self.precise(entries, precision))]
+
+        if self.stale or n > self.size:
+            self.size = max(n, self.size)
+            self.heap = heapq.nlargest(self.size, self.unique(self.artists.values()))
+            heapq.heapify(self.heap)
+            self.stale = False
+        newest = heapq.nlargest(n, self.precise(self.heap, precision))
+        if len(newest) < n and len(self.heap) < len(self.items):
+            # Too many of the newest tracks were left out, look at all of them.
+            newest = heapq.nlargest(n, self.precise(self.unique(self.artists.values()), precision))
+        return [i[2] for i in newest]
+
+    @staticmethod
+    def unique(groups):
+        '''The entries of `groups` once each, a track credited to more than one artist is in all of their groups'''
+        return {i[1]: i for i in chain.from_iterable(groups)}.values()
+
+    @staticmethod
+    def precise(entries, precision: int):
+        if precision == YEAR:
+            return entries
+        return (i for i in entries if date_precision(i[0]) >= precision)
+
+
+@dataclass
+class Catalog:
+    '''Every Artist, Album and Track we know about.'''
+
+    artists: Index = field(default_factory=Index)
+    albums: Index = field(default_factory=Index)
+    tracks: TrackIndex = field(default_factory=TrackIndex)
+    # Track ids that have been processed during the current track crawl.
+    seen: set = field(default_factory=set)
+    # album id -> its Tracks, fetched by the shards before the track crawl asks for them.
+    fetched: dict = field(default_factory=dict)
+    # Ids of the albums whose tracks couldnt all be fetched during the current track crawl.
+    failed: set = field(default_factory=set)
+    # "artist - name" -> ids of the albums with a later release of that track, which lost to the one we keep.
+    duplicates: dict = field(default_factory=dict)
+
+
+class Filter:
+    '''What gets into the catalog, from the filter section of config.json.
+
+    `groups` and `market` go along with the request, so the API leaves those albums out.
+    Album types, tracks shorter than `duration` seconds and names that match one of the
+    `exclude` patterns are dropped as the albums and tracks come in.'''
+
+    def __init__(self, groups: list = None, types: list = None, market: str = None, duration: float = 0, exclude=()) -> None:
+        self.groups = ','.join(groups) if groups else None
+        self.types = set(types or ())
+        self.market = market or None
+        self.duration = duration
+        self.exclude = re.compile('|'.join(f'(?:{i})' for i in exclude), re.IGNORECASE) if exclude else None
+
+    def key(self):
+        '''What the catalog depends on, None when nothing is filtered. A crawl with another key is a full resync.'''
+        if not (self.groups or self.types or self.market or self.duration or self.exclude):
+            return None
+        return [self.groups, sorted(self.types), self.market, self.duration, self.exclude and self.exclude.pattern]
+
+    def album(self, album: dict) -> bool:
+        '''Wether to keep an album from artist_albums'''
+        if self.types and album.get('album_type') not in self.types:
+            return False
+        return not (self.exclude and self.exclude.search(album['name']))
+
+    def track(self, name: str, seconds: float) -> bool:
+        if seconds < self.duration:
+            return False
+        return not (self.exclude and self.exclude.search(name))
@@ -0,0 +1,227 @@
+import asyncio
+import random
+import re
+import signal
+import time
+
+from datetime import datetime, timedelta
+from recentlier.util import log
+
+
+def duration(value) -> float:
+    '''"90", 90, "30s", "10m", "6h" or "1d" -> seconds'''
+    if isinstance(value, (int, float)):
+        return float(value)
+    match = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([smhd]?)\s*', str(value))
+    if not match:
+        raise ValueError(f'Unknown duration {value!r}')
+    return float(match[1]) * {'': 1, 's': 1, 'm': 60, 'h': 3600, 'd': 86400}[match[2]]
+
+
+class Interval:
+    '''Runs every `every` seconds, counted from when the last run ended'''
+
+    def __init__(self, every) -> None:
+        self.every = duration(every)
+
+    def next(self, after: float) -> float:
+        return after + self.every
+
+    def __repr__(self) -> str:
+        return f'every {self.every:g}s'
+
+
+class Cron:
+    '''A five field cron expression (minute hour day month weekday), in local time.
+
+    Fields take *, numbers, ranges (1-5), steps (*/15, 0-30/10) and lists (1,15). Weekday 0
+    and 7 are sunday. Like cron, when both day and weekday are restricted either one matches.'''
+
+    ranges = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+
+    def __init__(self, expression: str) -> None:
+        self.expression = expression
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ValueError(f'Cron expression {expression!r} needs five fields')
+        self.minutes, self.hours, self.days, self.months, weekdays = (
+            self.parse(field, *limits) for field, limits in zip(fields, self.ranges)
+        )
+        self.weekdays = {i % 7 for i in weekdays}
+        self.any_day = fields[2] == '*'
+        self.any_weekday = fields[4] == '*'
+
+    @staticmethod
+    def parse(field: str, low: int, high: int) -> set:
+        values = set()
+        for part in field.split(','):
+            part, _, step = part.partition('/')
+            if part == '*':
+                start, end = low, high
+            elif '-' in part:
+                start, end = (int(i) for i in part.split('-'))
+            else:
+                start = end = int(part)
+                if step:
+                    end = high
+            if not low <= start <= end <= high:
+                raise ValueError(f'Cron field {field!r} is out of range {low}-{high}')
+            values.update(range(start, end + 1, int(step or 1)))
+        return values
+
+    def day(self, when: datetime) -> bool:
+        day, weekday = when.day in self.days, (when.weekday() + 1) % 7 in self.weekdays
+        if self.any_day or self.any_weekday:
+            return day and weekday
+        return day or weekday
+
+    def next(self, after: float) -> float:
+        when = datetime.fromtimestamp(after).replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = when + timedelta(days=366 * 5)
+        while when < limit:
+            if when.month not in self.months:
+                when = (when.replace(day=1) + timedelta(days=32)).replace(day=1, hour=0, minute=0)
+            elif not self.day(when):
+                when = (when + timedelta(days=1)).replace(hour=0, minute=0)
+            elif when.hour not in self.hours:
+                when = (when + timedelta(hours=1)).replace(minute=0)
+            elif when.minute not in self.minutes:
+                when += timedelta(minutes=1)
+            else:
+                return when.timestamp()
+        raise ValueError(f'Cron expression {self.expression!r} never matches')
+
+    def __repr__(self) -> str:
+        return f'cron {self.expression}'
+
+
+def trigger(spec: dict):
+    '''{"every": "6h"} or {"cron": "30 4 * * *"}'''
+    if 'cron' in spec:
+        return Cron(spec['cron'])
+    return Interval(spec.get('every', '6h'))
+
+
+class Job:
+    def __init__(self, name: str, action, spec: dict) -> None:
+        self.name = name
+        self.action = action
+        self.trigger = trigger(spec)
+        self.jitter = duration(spec.get('jitter', 0))
+        self.enabled = spec.get('enabled', True)
+        self.due = 0.0
+        # Set by trigger(), a job that is asked for again while it waits or runs still runs once.
+        self.pending = False
+        self.running = False
+
+    def schedule(self, after: float) -> None:
+        self.due = self.trigger.next(after) + random.uniform(0, self.jitter)
+
+
+class Jobs:
+    '''Runs jobs on their own interval or cron trigger, one job at a time.
+
+    Jobs never overlap, a job that comes due while another one runs waits for it, and is
+    scheduled again from when it ended. trigger() runs a job, or every job in order, right
+    away. So does SIGUSR1, and a line like "run", "run albums" or "status" sent to
+    127.0.0.1:`port`.'''
+
+    def __init__(self, port: int = 0) -> None:
+        self.jobs: list = []
+        self.port = port
+        self.wake = None
+
+    def add(self, name: str, action, spec: dict) -> Job:
+        job = Job(name, action, spec)
+        self.jobs.append(job)
+        return job
+
+    def get(self, name: str):
+        return next((job for job in self.jobs if job.name == name), None)
+
+    def trigger(self, name: str = None) -> bool:
+        '''Runs `name`, or every job when not given, as soon as the running job is done'''
+        jobs = [job for job in self.jobs if name in (None, job.name) and job.enabled]
+        for job in jobs:
+            job.pending = True
+        if self.wake:
+            self.wake.set()
+        return bool(jobs)
+
+    def status(self) -> str:
+        lines = []
+        for job in self.jobs:
+            if not job.enabled:
+                state = 'disabled'
+            elif job.running:
+                state = 'running'
+            elif job.pending:
+                state = 'pending'
+            else:
+                state = f'next {datetime.fromtimestamp(job.due).strftime("%d/%m/%y %H:%M:%S")}'
+            lines.append(f'{job.name:<10} {job.trigger!r:<24} {state}')
+        return '\n'.join(lines)
+
+    async def run(self, start: bool = True) -> None:
+        '''Runs the jobs forever, every job starts right away if `start`'''
+        self.wake = asyncio.Event()
+        now = time.time()
+        for job in self.jobs:
+            job.pending = start and job.enabled
+            job.schedule(now)
+        await self.listen()
+
+        while True:
+            # Cleared before looking, so a trigger() from here on wakes the wait below.
+            self.wake.clear()
+            now = time.time()
+            ready = [job for job in self.jobs if job.enabled and (job.pending or job.due <= now)]
+            if ready:
+                await self.execute(ready[0])
+                continue
+
+            upcoming = min((job for job in self.jobs if job.enabled), key=lambda x: x.due, default=None)
+            if upcoming is None:
+                await self.wake.wait()
+            else:
+                log(f'Next job: {upcoming.name} at {datetime.fromtimestamp(upcoming.due).strftime("%d/%m/%y %H:%M:%S")}')
+                try:
+                    await asyncio.wait_for(self.wake.wait(), max(upcoming.due - now, 0))
+                except asyncio.TimeoutError:
+                    pass
+
+    async def execute(self, job: Job) -> None:
+        job.pending = False
+        job.running = True
+        try:
+            await job.action()
+        except Exception as R:
+            log(f'Job {job.name} failed -> Error {R}')
+        finally:
+            job.running = False
+            job.schedule(time.time())
+
+    async def listen(self) -> None:
+        try:
+            asyncio.get_running_loop().add_signal_handler(signal.SIGUSR1, self.trigger)
+        except (AttributeError, RuntimeError):
+            # No SIGUSR1 on Windows, and no signal handlers outside the main thread.
+            pass
+
+        if self.port:
+            await asyncio.start_server(self.command, '127.0.0.1', self.port)
+
+    async def command(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            words = (await reader.readline()).decode(errors='replace').split()
+            if words[:1] == ['run'] and len(words) <= 2:
+                name = words[1] if len(words) > 1 else None
+                reply = 'ok' if self.trigger(name) else f'unknown job {name}'
+            elif words == ['status']:
+                reply = self.status()
+            else:
+                reply = 'commands: run [job], status'
+            writer.write(reply.encode() + b'\n')
+            await writer.drain()
+        finally:
+            writer.close()
@@ -1,14 +1,21 @@
 #!/usr/bin/python3.10
 import asyncio
-import operator
+import bisect
+import functools
+import time
+import zlib
 
+from collections import Counter
 from datetime import datetime
 import sys
 import signal
-from typing import Any, Dict, List
-from recentlier.spotify import Spotify
-from recentlier.util import log, Cache, ProgressBar, Flags, Version
-from recentlier.classes import Artist, Playlist, Track, Album
+from typing import Dict, List, Optional, Tuple
+from recentlier.jobs import Jobs
+from recentlier.metrics import metrics
+from recentlier.shards import Shards
+from recentlier.spotify import Incomplete, Spotify
+from recentlier.util import log, Cache, ProgressBar, Flags, Version, DEBUG
+from recentlier.classes import Artist, Playlist, Track, Album, Catalog, Filter, Index, TrackIndex, date_key, PRECISIONS, YEAR
 
 def handler(sigum, frame) -> None:
     print('CTRL-C was pressed. Exiting.')
@@ -18,188 +25,477 @@ signal.signal(signal.SIGINT, handler)
 
 class Recentlier:
     spot = Spotify()
-    albumbuffer: list = []
-    tracks: list = []
 
     def __init__(self):
-        Version()
-        self.Artists: list = []
-        self.Albums: list = []
-        self.Tracks: list = []
-        self.playlist = Playlists(self)
+        self.started = time.perf_counter()
+        config = self.spot.config
+        Version(config.version_check)
+        self.catalog = Catalog()
+        self.filter = Filter(
+            config.filter_groups,
+            config.filter_types,
+            config.filter_market,
+            config.filter_min_duration,
+            config.filter_exclude or (),
+        )
+        self.shards = None
+        if config.shards > 1:
+            self.shards = Shards(config.shards, config.shard_dir, config.shard_local, config.shard_timeout)
+        # Per-artist high-water marks for the incremental album crawl.
+        self.Marks: dict = {}
+        self.resynced: float = 0
+        # With profiles.dir set every profile gets its own playlist, of its own artists, out of one
+        # shared catalog. The catalog is crawled once, with the client of the first profile.
+        profiles = [Playlists(self, self.spot.user(profile)) for profile in config.profiles()]
+        if profiles:
+            self.spot = profiles[0].spot
+        self.profiles = profiles or [Playlists(self)]
+        self.playlist = self.profiles[0]
         self.cache = Cache(self)
 
-    async def run(self):
-        # Preload from cache (if any)
-        while True:
-            await self.cache.load(self)
-            flags = Flags(self)
+    @property
+    def Artists(self) -> Index:
+        return self.catalog.artists
 
-            # Prepare the playlist first.
+    @Artists.setter
+    def Artists(self, data) -> None:
+        self.catalog.artists = data if isinstance(data, Index) else Index(data)
 
-            playlist = await self.playlist.get_playlist()
-            self.playlist.playlist = playlist
-            log(f"Playlist: {playlist.name} / {playlist.id}")
+    @property
+    def Albums(self) -> Index:
+        return self.catalog.albums
 
-            artists = await self.populate_artists()
-            await flags.check("artists", artists)
+    @Albums.setter
+    def Albums(self, data) -> None:
+        self.catalog.albums = data if isinstance(data, Index) else Index(data)
 
-            albums = await self.populate_albums(artists)
-            await flags.check("albums", albums)
+    @property
+    def Tracks(self) -> TrackIndex:
+        return self.catalog.tracks
 
-            if flags.run_tracks:
-                tracks = await self.populate_tracks(self.Albums)
-                await flags.check("tracks", tracks)
+    @Tracks.setter
+    def Tracks(self, data) -> None:
+        self.catalog.tracks = data if isinstance(data, TrackIndex) else TrackIndex(data)
 
-            if flags.update_playlist:
-                await self.playlist.update()
-                await self.cache.write()
+    async def run(self):
+        """Loads the cache, and runs the jobs on their schedule.
 
-            if self.spot.config.quitafter:
-                # If true, exit when done.
-                log("Done. Quitting.")
-                sys.exit(0)
+        With quit_after_update every job runs once, in order, and then we exit."""
+        config = self.spot.config
+        metrics.serve(config.metrics_port)
 
-            log("Sleeping for 6 hours.")
-            await asyncio.sleep(21600)
+        # Preload from cache (if any)
+        metrics.reset()
+        with metrics.phase("load"):
+            await self.cache.load(self)
+        load = metrics.done(config.metrics_file, "load")
+        self.flags = Flags(self)
+        log(f"Started in {time.perf_counter() - self.started:.2f}s, {load['phases']['load']:.2f}s of it loading the cache.")
+        # Logging in can wait for the user, so that happens now and never in the middle of a job.
+        for profile in self.profiles:
+            await profile.spot.get_token(interactive=True)
+
+        jobs = Jobs(config.schedule_port)
+        for name, action in (
+            ("artists", self.sync_artists),
+            ("albums", self.crawl_albums),
+            ("tracks", self.fetch_tracks),
+            ("playlist", self.push_playlist),
+            ("cache", self.compact_cache),
+        ):
+            jobs.add(name, functools.partial(self.execute, name, action), config.jobs.get(name, {}))
+        self.jobs = jobs
+
+        if config.quitafter:
+            # Cache compaction is left to the daemon.
+            for job in jobs.jobs[:-1]:
+                if job.enabled:
+                    await jobs.execute(job)
+            await self.cache.flush()
+            # If true, exit when done.
+            log("Done. Quitting.")
+            sys.exit(0)
+
+        await jobs.run()
+
+    async def execute(self, name: str, action) -> None:
+        """Runs one job, and records its metrics.
+
+        What we hold in memory is the state, unless another process wrote the cache since."""
+        metrics.reset()
+        if await self.cache.changed():
+            log("The cache was changed by another process, reloading it.")
+            with metrics.phase("load"):
+                await self.cache.load(self)
+            self.flags = Flags(self)
+        before = self.spot.connections()
+        await action()
+        # What the shared Session sent, and how much of it went over a connection that was kept alive.
+        opened, sent = (now - then for now, then in zip(self.spot.connections(), before))
+        reuse = ""
+        if sent:
+            metrics.count("connections", "opened", opened)
+            metrics.count("connections", "reused", sent - opened)
+            reuse = f", {sent - opened} of {sent} sent over a reused connection"
+        cycle = metrics.done(self.spot.config.metrics_file, name)
+        log(
+            f"Job {name} took {cycle['duration']:.1f}s, "
+            f"{sum(cycle.get('requests', {}).values()):.0f} requests, "
+            f"{cycle.get('bytes', {}).get('total', 0) / 1e6:.1f} MB received{reuse}"
+        )
 
-    async def populate_artists(self) -> List[Artist]:
-        """Creates a list of Artist-dataclasses."""
-        Artists = []
-        spotify = self.spot
+    async def sync_artists(self) -> None:
+        """Job: the followed artists, of every profile. Runs the album crawl when they changed."""
+        with metrics.phase("artists"):
+            if self.playlist.name is None:
+                artists, followed = await self.populate_artists(), False
+            else:
+                artists, followed = await self.populate_profiles()
+        await self.flags.check("artists", artists)
+        if self.flags.run_albums:
+            self.jobs.trigger("albums")
+        if followed:
+            # Someone follows an artist another profile already did, that only changes their playlist.
+            self.flags.update_playlist = True
+            self.jobs.trigger("playlist")
+
+    async def crawl_albums(self) -> None:
+        """Job: the albums of every artist that is due. Fetches the tracks when they changed."""
+        flags = self.flags
+        resynced = self.resynced
+        with metrics.phase("albums"):
+            albums = await self.shards.crawl(self) if self.shards else None
+            if albums is None:
+                albums = await self.populate_albums(self.Artists)
+        # A full album resync fetches every track again as well, and is remembered once they are in.
+        flags.full = self.resynced != resynced
+        await flags.check("albums", albums)
+        if flags.run_tracks:
+            self.jobs.trigger("tracks")
+        else:
+            # Remember when the artists were checked.
+            await self.cache.write()
+
+    async def fetch_tracks(self) -> None:
+        """Job: the tracks of the albums that changed, if any. Updates the playlist when they changed."""
+        flags = self.flags
+        if not flags.run_tracks:
+            log("No album changes, no tracks to fetch.")
+            return
+        with metrics.phase("tracks"):
+            tracks = await self.populate_tracks(flags.fetch, flags.keep)
+        await flags.check("tracks", tracks)
+        if flags.update_playlist:
+            self.jobs.trigger("playlist")
+
+    async def push_playlist(self) -> None:
+        """Job: brings the online playlist of every profile up to date, if the tracks changed."""
+        for profile in self.profiles:
+            with metrics.phase("playlist"):
+                playlist = await profile.get_playlist()
+            profile.playlist = playlist
+            log(f"Playlist: {playlist.name} / {playlist.id}" + (f" ({profile.name})" if profile.name else ""))
+
+        if not self.flags.update_playlist:
+            log("No track changes, the playlist is up to date.")
+            return
+        synced = True
+        for profile in self.profiles:
+            with metrics.phase("update"):
+                synced = await profile.update() and synced
+        # A playlist we couldnt read or write is tried again next cycle.
+        self.flags.update_playlist = not synced
+        await self.cache.write()
+
+    async def compact_cache(self) -> None:
+        """Job: rewrites the cache, to give back the space of what was removed from it."""
+        await self.cache.compact()
+
+    async def populate_profiles(self) -> Tuple[Index, bool]:
+        """The artists followed by any of the profiles, and wether what a profile follows changed.
+
+        Every profile remembers the ids of its own artists, an artist that more than one of
+        them follows is in the Index, and crawled, once."""
+        Artists = Index()
+        changed = False
+        followed = await asyncio.gather(*[self.populate_artists(profile.spot) for profile in self.profiles])
+        for profile, artists in zip(self.profiles, followed):
+            ids = list(artists.ids())
+            if profile.artists is None or set(ids) != set(profile.artists):
+                log(f"{profile.name} follows {len(ids)} artists")
+                changed = True
+            profile.artists = ids
+            for artist in artists:
+                Artists.append(artist)
+        return Artists, changed
+
+    async def populate_artists(self, spotify: Spotify = None) -> Index:
+        """Creates an Index of Artist-dataclasses, of the user of `spotify` if given.
+
+        Raises Incomplete when a page fails, part of the list would look like unfollowed artists."""
+        Artists = Index()
+        spotify = spotify or self.spot
 
         results = await spotify.get_artists(limit=50)
-        for artist in results["artists"]["items"]:
-            Artists.append(Artist(id=artist["id"], name=artist["name"]))
+        async for artist in spotify.items(results, "artists"):
+            Artists.append(Artist.create(artist["id"], artist["name"]))
 
-            log(
-                f'Appended {artist["name"]} to Artists',
-                silent=not spotify.config.verbose,
-            )
-
-        while "next" in results["artists"] and results["artists"]["next"] is not None:
-            results = await spotify.next(results["artists"])
-
-            for artist in results["artists"]["items"]:
-                Artists.append(Artist(id=artist["id"], name=artist["name"]))
-
-                log(
-                    f'Appended {artist["name"]} to Artists',
-                    silent=not spotify.config.verbose,
-                )
+            log("Appended %s to Artists", artist["name"], level=DEBUG)
+        metrics.count("objects", "artists", len(Artists))
         return Artists
 
-    async def populate_albums(self, artists: Artist) -> List[Album]:
-        """creates a list of Album-databalasses"""
-        progressbar = ProgressBar(len(self.Artists), "Populating albums")
-        Albums = []
-        spotify = self.spot
-        for artist in artists:
-            results = await spotify.artist_albums(artist.id, limit=50)
-
-            for album in results["items"]:
-                if album["id"] not in Albums:
+    async def populate_albums(self, artists: Index) -> Index:
+        """creates an Index of Album-dataclasses, fetching artists concurrently.
+
+        In incremental mode an artist is only paged until we reach albums we already know
+        about, and the rest are taken from the cache. Every `full_resync` hours all pages are
+        fetched again.
+
+        Between full resyncs an artist is only checked when its refresh tier is due, see due()."""
+        config = self.spot.config
+        now = time.time()
+        key = self.filter.key()
+        full = not config.incremental or now - self.resynced > config.full_resync * 3600
+        # Albums and tracks that were filtered out, or in, are only back with every track fetched again.
+        marks = [self.Marks[artist.id] for artist in artists if artist.id in self.Marks]
+        full = full or any(mark.get("filter") != key for mark in marks)
+        cached = self.Albums
+        progressbar = ProgressBar(len(artists), "Populating albums")
+        Albums = Index()
+
+        if full:
+            log("Doing a full album resync.")
+        skipped = []
+
+        async def fetch(artist: Artist) -> Tuple[Optional[Dict], Optional[Tuple[List[Dict], int]]]:
+            mark = self.Marks.get(artist.id)
+            if mark and mark.get("filter") != key:
+                # The albums of this artist were filtered differently.
+                mark = None
+            if mark and not all(album_id in cached for album_id in set(mark["albums"]) - set(mark.get("dropped", ()))):
+                # The cache doesnt hold everything this mark knows about.
+                mark = None
+            if mark and not full and not self.due(artist, mark, now):
+                metrics.count("cache_hits", "artists")
+                skipped.append(artist)
+                progressbar.progress()
+                return mark, None
+            metrics.count("cache_misses", "artists")
+            result = await self.get_artist_albums(artist, None if full else mark)
+            progressbar.progress()
+            return mark, result
+
+        # gather() keeps the order of `artists`, so the merge below is deterministic
+        # no matter in which order the requests complete.
+        results = await asyncio.gather(*[fetch(artist) for artist in artists])
+        if skipped:
+            progressbar.done()
+            log(f"Checked {len(artists) - len(skipped)} of {len(artists)} artists, the others are not due yet.")
+
+        for artist, (mark, result) in zip(artists, results):
+            failed = result is None
+            if failed:
+                if not mark:
+                    continue
+                # Keep what we knew about this artist if it wasnt due, or the request failed.
+                result = ([], mark["total"])
+            items, total = result
+
+            seen = [album["id"] for album in items]
+            dates = [album["release_date"] for album in items]
+            # Filtered out albums are remembered, so the incremental crawl still knows them.
+            dropped = []
+            for album in items:
+                if not self.filter.album(album):
+                    metrics.count("filtered", "albums")
+                    dropped.append(album["id"])
+                elif album["id"] not in Albums:
+                    metrics.count("cache_misses", "albums")
+                    metrics.count("objects", "albums")
                     Albums.append(
                         Album(
                             id=album["id"],
-                            release_date=album["release_date"],
                             name=album["name"],
-                            artist_name=artist.name,
-                            artist_id=artist.id,
+                            date=date_key(album["release_date"]),
+                            artist=artist,
                         )
                     )
 
-                    log(
-                        f'Appended {album["name"]} to Albums',
-                        silent=not spotify.config.verbose,
-                    )
+                    log("Appended %s to Albums", album["name"], level=DEBUG)
 
-            while "next" in results and results["next"] is not None:
-                results = await spotify.next(results)
-
-                for album in results["items"]:
-                    if album["id"] not in Albums:
-                        Albums.append(
-                            Album(
-                                id=album["id"],
-                                release_date=album["release_date"],
-                                name=album["name"],
-                                artist_name=artist.name,
-                                artist_id=artist.id,
-                            )
-                        )
-
-                        log(
-                            f'Appended {album["name"]} to Albums',
-                            silent=not spotify.config.verbose,
-                        )
+            if mark and (failed or not full):
+                skip = set(mark.get("dropped", ()))
+                for album_id in mark["albums"]:
+                    if album_id in seen:
+                        continue
+                    seen.append(album_id)
+                    if album_id in skip:
+                        dropped.append(album_id)
+                        continue
+                    dates.append(cached[album_id].release_date)
+                    if album_id not in Albums:
+                        metrics.count("cache_hits", "albums")
+                        Albums.append(cached[album_id])
+
+            self.Marks[artist.id] = {
+                "total": total,
+                "release_date": max(dates, default=None),
+                "albums": seen,
+                "checked": mark.get("checked", 0) if failed else now,
+                "dropped": dropped,
+                "filter": key,
+            }
+
+        if full:
+            self.resynced = time.time()
 
-            progressbar.progress()
         progressbar.done()
         return Albums
 
-    async def add_to_buffer(self, input: str) -> Any:
-        """Return only when buffer is full"""
+    def due(self, artist: Artist, mark: Dict, now: float) -> bool:
+        """Wether the albums of `artist` should be checked again.
 
-        if len(self.albumbuffer) + 1 == 20:
-            self.albumbuffer.append(input)
-            data = self.albumbuffer
-            self.albumbuffer = []
-
-            return data
+        Artists are put in a refresh tier by how long ago their last release was, and every
+        tier has its own interval (application.refresh_tiers, [days, hours] pairs). Artists
+        are due a bit early depending on their id, which spreads a tier over its interval
+        instead of having all of it come due in the same cycle."""
+        key = date_key(mark.get("release_date"))
+        if key // 10000 < 1:
+            age = float("inf")
         else:
-            self.albumbuffer.append(input)
+            released = datetime(key // 10000, max(key // 100 % 100, 1), max(key % 100, 1)).timestamp()
+            age = (now - released) / 86400
 
-        return False
+        tiers = self.spot.config.refresh_tiers
+        hours = next((hours for days, hours in tiers if days is None or age <= days), tiers[-1][1])
+        spread = zlib.crc32(artist.id.encode()) % 1000 / 4000
+        return now - mark.get("checked", 0) >= hours * 3600 * (0.9 - spread)
 
-    async def populate_tracks(self, albums: Album) -> List[Track]:
-        """Creates a list of Track-dataclasses"""
+    async def get_artist_albums(self, artist: Artist, mark: Dict = None) -> Optional[Tuple[List[Dict], int]]:
+        """Pages through the albums of a single artist, returns the albums and their total.
 
-        duplicates = {}
-        progressbar = ProgressBar(len(albums), "Populating tracks")
+        With a `mark` from the previous crawl paging stops once we reach known albums
+        and have found as many new ones as the total has grown by, so the pages are
+        fetched one by one. Without one they are all fetched at once."""
+        spotify = self.spot
 
-        Tracks = []
+        # Spotipy 2.19 has no include_groups yet, so they are only passed when the filter sets them.
+        request = {"include_groups": self.filter.groups, "country": self.filter.market}
+        results = await spotify.artist_albums(artist.id, limit=50, **{name: value for name, value in request.items() if value})
+        if not results:
+            log(f"Unable to fetch albums for {artist.name}, skipping.")
+            return None
+        total = results.get("total", len(results["items"]))
+        try:
+            if not mark:
+                return [album async for album in spotify.items(results)], total
+
+            known = set(mark["albums"])
+            added = total - mark["total"]
+            items = []
+            async for page in spotify.pages(results, eager=False):
+                items.extend(page["items"])
+                new = sum(1 for album in items if album["id"] not in known)
+                if new < len(items) and new >= added:
+                    break
+        except Incomplete:
+            # A mark with the total but not every album would never page for the missing ones.
+            log(f"Unable to fetch every album of {artist.name}, skipping.")
+            return None
 
-        for album in albums:
-            data = await self.add_to_buffer(album.id)
-            progressbar.progress()
-            if not data:
-                continue
-            else:
-                for track in await self.get_track_data(data, album):
-                    this = f"{track.artist_name} - {track.name}"
-                    if this in duplicates:
-                        duplicates[this].append(track)
-                    else:
-                        duplicates[this] = []
-                        duplicates[this].append(track)
-
-        if len(self.albumbuffer) != 0:
-            # Check if buffer has "leftover" albums in it.
-            for track in await self.get_track_data(self.albumbuffer, album):
-                this = f"{track.artist_name} - {track.name}"
-                if this in duplicates:
-                    duplicates[this].append(track)
-                else:
-                    duplicates[this] = []
-                    duplicates[this].append(track)
+        return items, total
+
+    async def populate_tracks(self, albums: Index, known=()) -> TrackIndex:
+        """Creates a TrackIndex of Track-dataclasses from the tracks of `albums` and the `known` ones.
 
+        This is a pipeline: album ids are queued 20 at a time, a pool of workers fetches the
+        batches and the remaining pages of their tracks concurrently, and duplicates are
+        resolved to the earliest release as the results come in. A known track wins over a
+        fetched one with the same release date, and keeps its place in the order."""
+        spotify = self.spot
+        progressbar = ProgressBar(len(albums), "Populating tracks")
+        self.catalog.seen = {track.id for track in known}
+        self.catalog.failed = set()
+        workers = spotify.config.concurrency
+
+        batches = asyncio.Queue(maxsize=workers * 2)
+        found = asyncio.Queue()
+
+        async def produce() -> None:
+            ids = [album.id for album in albums]
+            for number, index in enumerate(range(0, len(ids), 20)):
+                await batches.put((number, ids[index : index + 20]))
+            for _ in range(workers):
+                await batches.put(None)
+
+        async def fetch() -> None:
+            while (batch := await batches.get()) is not None:
+                number, data = batch
+                await found.put((number, await self.get_track_data(data)))
+                for _ in data:
+                    progressbar.progress()
+            await found.put(None)
+
+        # "artist - name" -> ((release_date, order), Track, first order seen, duplicates, their album ids)
+        duplicates = {}
+
+        def add(track: Track, order: Tuple[int, int]) -> None:
+            # Ties go to the track that comes first in album order, no matter which batch finished first.
+            this = f"{track.artist_name} - {track.name}"
+            key = (track.date, order)
+            if this not in duplicates:
+                duplicates[this] = [key, track, order, 1, {track.album_id}]
+                return
+            entry = duplicates[this]
+            entry[2] = min(entry[2], order)
+            entry[3] += 1
+            entry[4].add(track.album_id)
+            if key < entry[0]:
+                entry[0], entry[1] = key, track
+
+        for position, track in enumerate(known):
+            add(track, (-1, position))
+
+        async def merge() -> None:
+            running = workers
+            while running:
+                if (result := await found.get()) is None:
+                    running -= 1
+                    continue
+                number, tracks = result
+                for position, track in enumerate(tracks):
+                    add(track, (number, position))
+
+        await asyncio.gather(produce(), merge(), *[fetch() for _ in range(workers)])
+        self.catalog.fetched = {}
+        # Albums whose tracks couldnt all be fetched keep the tracks we had, Flags has them fetched again next time.
+        for position, track in enumerate(self.Tracks):
+            if track.album_id in self.catalog.failed and track.id not in self.catalog.seen:
+                add(track, (-1, len(known) + position))
         progressbar.done()
 
+        # The losers of albums that werent fetched again are only known from the previous crawls.
+        refreshed = {album.id for album in albums} - self.catalog.failed
+        previous = self.catalog.duplicates
+        self.catalog.duplicates = {}
+        for this, (_, earliest, _, _, album_ids) in duplicates.items():
+            lost = album_ids.union(i for i in previous.get(this, ()) if i not in refreshed)
+            lost.discard(earliest.album_id)
+            if lost:
+                self.catalog.duplicates[this] = sorted(lost)
+
+        Tracks = TrackIndex()
         progressbar = ProgressBar(len(duplicates), "Sorting tracks")
-        for track in duplicates:
-            # Get the earliest release date from the duplicates.
-            earliest = min(duplicates[track], key=lambda x: x.release_date)
+        for _, earliest, _, count, _ in sorted(duplicates.values(), key=lambda x: x[2]):
             log(
-                f"{earliest.name} has the earliest release date of {earliest.release_date} out of"
-                f" {len(duplicates[track])} duplicates",
-                silent=not self.spot.config.verbose,
+                "%s has the earliest release date of %s out of %s duplicates",
+                earliest.name,
+                earliest.release_date,
+                count,
+                level=DEBUG,
             )
             Tracks.append(earliest)
-            log(
-                f"Appended {earliest.artist_name} - {earliest.name} to Tracks",
-                silent=not self.spot.config.verbose,
-            )
+            log("Appended %s - %s to Tracks", earliest.artist_name, earliest.name, level=DEBUG)
             progressbar.progress()
         progressbar.done()
 
@@ -212,101 +508,260 @@ class Recentlier:
                 return artist
         return False
 
-    async def get_track_data(self, data: list, _album) -> List[Track]:
-        Tracks = []
-        spotify = self.spot
-
-        results = await spotify.get_several_albums(data)
+    async def get_track_data(self, data: list) -> List[Track]:
+        """The tracks of up to 20 albums that werent processed yet, fetched unless the shards already did"""
+        fetched = self.catalog.fetched
+        missing = [album_id for album_id in data if album_id not in fetched]
+        found = await self.get_album_tracks(missing) if missing else {}
 
-        for album in results["albums"]:
-            release_date = album["release_date"]
-
-            for track in album["tracks"]["items"]:
-                track_id = track["id"]
-                track_name = track["name"]
-                duration = track["duration_ms"] * 1000
-                track_artists = track["artists"]
-
-                if track_id in self.tracks:
+        Tracks = []
+        for album_id in data:
+            for track in fetched.pop(album_id, None) or found.get(album_id, ()):
+                if track.id in self.catalog.seen:
                     # skip this track, if track id has been processed.
                     continue
+                self.catalog.seen.add(track.id)
+                Tracks.append(track)
+        metrics.count("objects", "tracks", len(Tracks))
+        return Tracks
 
-                else:
-                    if get_artist := await self.check_artist_in_track(track_artists):
-                        self.tracks.append(track_id)
-                        Tracks.append(
-                            Track(
-                                id=track_id,
-                                name=track_name,
-                                release_date=release_date,
-                                duration=duration,
-                                artist_id=get_artist["id"],
-                                artist_name=get_artist["name"],
-                            )
-                        )
+    async def get_album_tracks(self, data: list) -> Dict[str, List[Track]]:
+        """Fetches up to 20 albums, and the remaining pages of their tracks concurrently.
 
-            while "next" in album and album["next"] is not None:
-                album = await spotify.next(album)
-                for track in album["items"]:
-                    track_id = track["id"]
-                    track_name = track["name"]
-                    duration = track["duration_ms"] * 1000
-                    track_artists = track["artists"]
+        Returns the tracks of the artists we follow, by album id."""
+        spotify = self.spot
 
-                    if track_id in self.tracks:
+        # Spotipy 2.19 takes no market for albums(), it is only passed when the filter sets one.
+        market = {"market": self.filter.market} if self.filter.market else {}
+        results = await spotify.get_several_albums(data, **market)
+        if not results:
+            log(f"Unable to fetch {len(data)} albums, skipping.")
+            self.catalog.failed.update(data)
+            return {}
+
+        pages = await asyncio.gather(*[self.get_album_pages(album["tracks"]) for album in results["albums"]])
+
+        Albums = {}
+        for album_id, album, items in zip(data, results["albums"], pages):
+            if items is None:
+                log(f"Unable to fetch every track of {album['name']}, skipping.")
+                self.catalog.failed.add(album_id)
+                continue
+            date = date_key(album["release_date"])
+            Tracks = Albums[album_id] = []
+
+            for track in items:
+                if get_artist := await self.check_artist_in_track(track["artists"]):
+                    credits = tuple(artist["id"] for artist in track["artists"])
+                    if not self.filter.track(track["name"], track["duration_ms"] / 1000):
+                        metrics.count("filtered", "tracks")
                         continue
+                    Tracks.append(
+                        Track(
+                            id=track["id"],
+                            name=track["name"],
+                            date=date,
+                            duration=track["duration_ms"] * 1000,
+                            artist=self.Artists[get_artist["id"]],
+                            album_id=album_id,
+                            # Most tracks have one artist, `artist` is enough for those.
+                            credits=credits if len(credits) > 1 else (),
+                        )
+                    )
+        return Albums
 
-                    else:
-                        if get_artist := await self.check_artist_in_track(
-                            track_artists
-                        ):
-                            self.tracks.append(track_id)
-                            Tracks.append(
-                                Track(
-                                    id=track_id,
-                                    name=track_name,
-                                    release_date=release_date,
-                                    duration=duration,
-                                    artist_id=get_artist["id"],
-                                    artist_name=get_artist["name"],
-                                )
-                            )
-        return Tracks
+    async def get_album_pages(self, results: Dict) -> Optional[List[Dict]]:
+        """Every track of an album, the pages after the first one are fetched at once. None if a page failed."""
+        try:
+            return [track async for track in self.spot.items(results)]
+        except Incomplete:
+            return None
 
 
 class Playlists:
     playlist: str = None
 
-    def __init__(self, recentlier):
-        self.spot = recentlier.spot
+    def __init__(self, recentlier, spot: Spotify = None):
+        self.spot = spot or recentlier.spot
         self.recentlier = recentlier
+        # The ids of the artists of this profile, every artist in the catalog without profiles.
+        self.artists: Optional[List[str]] = None
+
+    @property
+    def name(self) -> Optional[str]:
+        return self.spot.config.profile
 
-    async def update(self):
+    async def update(self) -> bool:
+        """Brings the online playlist up to date, False if it couldnt be read or written"""
         log("----------------------------")
-        new_tracks = await self.order()
+        new_tracks = await self.order(self.artists)
         new_tracks = new_tracks[::-1]
         playlist_tracks = await self.get_playlist_tracks()
 
-        if set([i.id for i in new_tracks]) == set(playlist_tracks):
+        if playlist_tracks is None:
+            # Syncing against part of the playlist would add the rest of it again.
+            log("Unable to read the online playlist, skipping.")
+            return False
+
+        if [i.id for i in new_tracks] == playlist_tracks:
             log("The local playlist and online playlist are identical.")
 
         else:
-            me = await self.spot.me()
             log("Updating online playlist")
-            await self.spot.add_tracks(
-                me["id"], self.playlist.id, [i.id for i in new_tracks]
-            )
+            if not await self.sync(playlist_tracks, [i.id for i in new_tracks]):
+                log("Unable to update the online playlist, skipping.")
+                return False
 
             for track in new_tracks:
                 log(f"{track.artist_name} - {track.name} ({track.release_date})")
         await self.update_playlist_details()
+        return True
+
+    async def sync(self, current: List[str], desired: List[str]) -> bool:
+        """Turns the online playlist from `current` into `desired` with as few calls as possible.
+
+        Tracks that shouldnt be there are removed, the remaining ones are put in order with
+        moves(), and the missing ones are added in runs. Removes and adds go 100 at a time,
+        which is the most the API takes per call. If that takes more calls than replacing the
+        whole playlist, or the playlist holds tracks without an id, it is replaced instead.
+        False if a call failed."""
+        if None in current:
+            # Local files and unavailable tracks cant be removed or moved by id.
+            return await self.replace(desired)
+
+        spotify = self.spot
+        playlist_id = self.playlist.id
+        snapshot = None
+        wanted = set(desired)
+        counts = Counter(current)
+
+        # Duplicates are removed and added back once.
+        remove = [i for i in counts if i not in wanted or counts[i] > 1]
+        removed = set(remove)
+        local = [i for i in current if i not in removed]
+        missing = wanted - set(local)
+        moves = self.moves(local, [i for i in desired if i not in missing])
+        adds = self.runs(desired, missing)
+
+        if -(-len(remove) // 100) + len(moves) + len(adds) > max(1, -(-len(desired) // 100)):
+            return await self.replace(desired)
+
+        for batch in range(0, len(remove), 100):
+            result = await spotify.remove_playlist_items(playlist_id, remove[batch : batch + 100], snapshot_id=snapshot)
+            if not result:
+                return False
+            snapshot = result["snapshot_id"]
+
+        for start, length, insert_before in moves:
+            result = await spotify.reorder_playlist_items(
+                playlist_id, range_start=start, insert_before=insert_before, range_length=length, snapshot_id=snapshot
+            )
+            if not result:
+                return False
+            snapshot = result["snapshot_id"]
+
+        # Everything in the playlist is in order now, so each run of missing tracks goes in at its final position.
+        for start, end in adds:
+            result = await spotify.add_playlist_items(playlist_id, desired[start:end], position=start)
+            if not result:
+                return False
+            snapshot = result["snapshot_id"]
+        return True
+
+    async def replace(self, desired: List[str]) -> bool:
+        """Replaces every item of the online playlist with `desired`, False if a call failed"""
+        spotify = self.spot
+        # A replace takes 100 tracks, the rest are added after them.
+        result = await spotify.replace_playlist_items(self.playlist.id, desired[:100])
+        for batch in range(100, len(desired), 100):
+            if not result:
+                break
+            result = await spotify.add_playlist_items(self.playlist.id, desired[batch : batch + 100])
+        return bool(result)
+
+    @classmethod
+    def moves(cls, local: List[str], present: List[str]) -> List[Tuple[int, int, int]]:
+        """The reorder calls that put `local` in the order of `present`, as (range_start, range_length, insert_before).
+
+        Everything outside the longest increasing subsequence is moved right behind whatever
+        precedes it in `present`, along with the tracks after it that follow it there as well."""
+        position = {track_id: index for index, track_id in enumerate(present)}
+        keep = set(cls.longest_increasing([position[i] for i in local]))
+        local = list(local)
+        moves = []
+        index = 0
+        while index < len(present):
+            if index in keep:
+                index += 1
+                continue
+            start = local.index(present[index])
+            length, end = 1, min(len(present), index + len(local) - start)
+            while index + length < end and index + length not in keep and local[start + length] == present[index + length]:
+                length += 1
+            insert_before = local.index(present[index - 1]) + 1 if index else 0
+            if insert_before != start:
+                moves.append((start, length, insert_before))
+                run = local[start : start + length]
+                del local[start : start + length]
+                at = insert_before - length if insert_before > start else insert_before
+                local[at:at] = run
+            index += length
+        return moves
+
+    @staticmethod
+    def runs(desired: List[str], missing: set) -> List[Tuple[int, int]]:
+        """The (start, end) of every run of `missing` tracks in `desired`, at most 100 long"""
+        runs = []
+        index = 0
+        while index < len(desired):
+            if desired[index] in missing:
+                run = index
+                while run < len(desired) and run - index < 100 and desired[run] in missing:
+                    run += 1
+                runs.append((index, run))
+                index = run
+            else:
+                index += 1
+        return runs
+
+    @staticmethod
+    def longest_increasing(sequence: List[int]) -> List[int]:
+        """Longest strictly increasing subsequence, O(n log n)"""
+        tails, indexes, previous = [], [], [-1] * len(sequence)
+        for index, value in enumerate(sequence):
+            at = bisect.bisect_left(tails, value)
+            if at == len(tails):
+                tails.append(value)
+                indexes.append(index)
+            else:
+                tails[at] = value
+                indexes[at] = index
+            previous[index] = indexes[at - 1] if at else -1
+
+        result = []
+        index = indexes[-1] if indexes else -1
+        while index != -1:
+            result.append(sequence[index])
+            index = previous[index]
+        return result[::-1]
 
-    async def get_playlist_tracks(self) -> dict:
+    async def get_playlist_tracks(self) -> Optional[List[str]]:
+        """Pages through the whole online playlist, None if any page of it failed.
+
+        Items we cant address by track id are None, so the positions stay those of the playlist."""
         spotify = self.spot
         tracks = []
-        results = await spotify.playlist_tracks(self.playlist.id, limit=100)
-        for track in results["items"]:
-            tracks.append(track["track"]["id"])
+        results = await spotify.playlist_items(self.playlist.id, limit=100)
+        if not results:
+            return None
+        try:
+            async for item in spotify.items(results):
+                # Local files have a track without an id, unavailable ones have none, and episodes arent tracks.
+                track = item.get("track") or {}
+                local = item.get("is_local") or track.get("is_local")
+                tracks.append(track.get("id") if track.get("type", "track") == "track" and not local else None)
+        except Incomplete:
+            return None
         return tracks
 
     async def update_playlist_details(self):
@@ -345,7 +800,7 @@ class Playlists:
             # and look through all of them for playlist_name.
             playlists = []
             result = await spotify.playlists(me["id"], limit=50)
-            for playlist in result["items"]:
+            async for playlist in spotify.items(result):
                 playlists.append(
                     Playlist(
                         id=playlist["id"],
@@ -354,17 +809,6 @@ class Playlists:
                         name=playlist["name"],
                     )
                 )
-            while "next" in result and result["next"] is not None:
-                result = await spotify.next(result)
-                for playlist in result["items"]:
-                    playlists.append(
-                        Playlist(
-                            id=playlist["id"],
-                            owner=playlist["owner"]["display_name"],
-                            tracks=playlist["tracks"]["href"],
-                            name=playlist["name"],
-                        )
-                    )
 
             for playlist in playlists:
                 if spotify.config.playlist_name == playlist.name:
@@ -410,10 +854,12 @@ class Playlists:
             new = 0
         return playlist
 
-    async def order(self):
-        """sorts the entire list by release_date"""
-        ordered = sorted(
-            self.recentlier.Tracks, key=operator.attrgetter("release_date")
-        )
+    async def order(self, artists=None):
+        """the newest `playlist_size` tracks (by `artists`, if given), oldest first.
+
+        Tracks whose release date is less precise than `playlist_precision` are left out."""
+        config = self.spot.config
+        precision = PRECISIONS.get(str(config.playlist_precision).lower(), YEAR)
+        newest = self.recentlier.Tracks.newest(int(config.playlist_size), artists, precision)
 
-        return ordered[-int(self.spot.config.playlist_size) :]
+        return newest[::-1]
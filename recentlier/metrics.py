@@ -0,0 +1,131 @@
+import json
+import threading
+import time
+
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class Metrics:
+    '''Counters and phase timings of the current run cycle.
+
+    Counters are named, and can have one label (count('requests', 'artist_albums')).
+    Each finished cycle is appended to a json-lines file, and the running totals can be
+    scraped in the Prometheus text format from a local port.'''
+
+    # The Prometheus label name used for each counter's label.
+    labels = {
+        'requests': 'endpoint',
+        'retries': 'endpoint',
+        'throttled': 'endpoint',
+        'objects': 'kind',
+        'filtered': 'kind',
+        'cache_hits': 'cache',
+        'cache_misses': 'cache',
+        'connections': 'state',
+    }
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.totals: dict = {}
+        self.cycles = 0
+        self.last = None
+        self.server = None
+        self.reset()
+
+    def reset(self) -> None:
+        self.counters: dict = {}
+        self.durations: dict = {}
+        self.started = time.time()
+
+    def count(self, name: str, label: str = None, value: float = 1) -> None:
+        '''Adds `value` to a counter, safe to call from the worker threads'''
+        with self.lock:
+            self.counters[(name, label)] = self.counters.get((name, label), 0) + value
+            self.totals[(name, label)] = self.totals.get((name, label), 0) + value
+
+    @contextmanager
+    def phase(self, name: str):
+        '''Times a phase of the cycle, a phase that runs more than once adds up'''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.durations[name] = self.durations.get(name, 0) + time.perf_counter() - start
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            counters = dict(self.counters)
+        data = {'time': self.started, 'duration': time.time() - self.started, 'phases': dict(self.durations)}
+        for (name, label), value in sorted(counters.items(), key=lambda x: (x[0][0], x[0][1] or '')):
+            data.setdefault(name, {})[label or 'total'] = value
+
+        data['cache_ratio'] = {}
+        for cache, hits in data.get('cache_hits', {}).items():
+            misses = data.get('cache_misses', {}).get(cache, 0)
+            data['cache_ratio'][cache] = hits / (hits + misses) if hits + misses else None
+        return data
+
+    def done(self, path: str = None, job: str = None) -> dict:
+        '''Ends the cycle of `job`, appends it to `path` and starts counting the next one'''
+        data = self.snapshot()
+        if job:
+            data['job'] = job
+        if path:
+            with open(path, 'a') as handle:
+                handle.write(json.dumps(data) + '\n')
+        self.cycles += 1
+        self.last = data
+        self.reset()
+        return data
+
+    def prometheus(self) -> str:
+        '''Running totals, and the phase durations of the last finished cycle'''
+        with self.lock:
+            totals = dict(self.totals)
+
+        lines = ['# TYPE recentlier_cycles_total counter', f'recentlier_cycles_total {self.cycles}']
+        names = sorted({name for name, _ in totals})
+        for name in names:
+            lines.append(f'# TYPE recentlier_{name}_total counter')
+            for (_name, label), value in sorted(totals.items(), key=lambda x: x[0][1] or ''):
+                if _name != name:
+                    continue
+                labels = f'{{{self.labels.get(name, "label")}="{label}"}}' if label else ''
+                lines.append(f'recentlier_{name}_total{labels} {value}')
+
+        last = self.last
+        if last:
+            lines.append('# TYPE recentlier_phase_seconds gauge')
+            for phase, seconds in last['phases'].items():
+                lines.append(f'recentlier_phase_seconds{{phase="{phase}"}} {seconds:.3f}')
+            lines.append('# TYPE recentlier_cycle_seconds gauge')
+            lines.append(f'recentlier_cycle_seconds {last["duration"]:.3f}')
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port: int) -> None:
+        '''Exposes /metrics on 127.0.0.1:`port` from a background thread'''
+        if self.server or not port:
+            return
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self) -> None:
+                if self.path.rstrip('/') != '/metrics':
+                    self.send_error(404)
+                    return
+                body = metrics.prometheus().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args) -> None:
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        threading.Thread(target=self.server.serve_forever, name='metrics', daemon=True).start()
+
+
+metrics = Metrics()
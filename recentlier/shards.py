@@ -0,0 +1,224 @@
+import asyncio
+import glob
+import multiprocessing
+import os
+import pickle
+import sys
+import time
+import zlib
+
+from typing import Optional
+
+from recentlier.classes import Index
+from recentlier.metrics import metrics
+from recentlier.spotify import Spotify
+from recentlier.util import log, logger
+
+
+def shard(artist_id: str, count: int) -> int:
+    '''The shard of an artist, the same in every process and on every machine'''
+    return zlib.crc32(artist_id.encode()) % count
+
+
+def dump(path: str, data) -> None:
+    # Written next to it and moved in place, so nobody reads half a file.
+    with open(f'{path}.tmp', 'wb') as handle:
+        pickle.dump(data, handle, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(f'{path}.tmp', path)
+
+
+def load(path: str):
+    with open(path, 'rb') as handle:
+        return pickle.load(handle)
+
+
+class Shards:
+    '''Crawls the albums and tracks of the followed artists in `count` workers, and merges what they found.
+
+    The coordinator writes a task to `directory`: every artist, the marks and the albums we
+    know about. Every worker takes the artists of its shard, by a stable hash of their id,
+    crawls their albums, fetches the tracks of the albums that are new or changed, and writes
+    that back as a partial result. The albums are merged in the order of the artists, and the
+    tracks are handed to populate_tracks, which takes them instead of asking the API again and
+    dedupes them like any other.
+
+    With `local` the workers are processes started for every crawl. Otherwise they run as
+    `run.py --shard <index>/<count>` on machines that share the directory.'''
+
+    def __init__(self, count: int, directory: str, local: bool = True, timeout: float = 3600) -> None:
+        self.count = count
+        self.directory = directory
+        self.local = local
+        self.timeout = timeout
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.directory, f'{name}.pickle')
+
+    async def crawl(self, recentlier) -> Optional[Index]:
+        '''The albums of every artist, or None if a worker failed and we have to crawl them ourselves'''
+        task = {
+            'id': f'{time.time_ns():x}',
+            'count': self.count,
+            'artists': list(recentlier.Artists),
+            'albums': list(recentlier.Albums),
+            'marks': recentlier.Marks,
+            'resynced': recentlier.resynced,
+            # Fetch the tracks of every album, like Flags does for caches without album ids.
+            'full': any(track.album_id is None for track in recentlier.Tracks),
+        }
+        recentlier.catalog.fetched = {}
+        for path in glob.glob(self.path('*-*')):
+            os.remove(path)
+        dump(self.path('task'), task)
+        log(f'Crawling {len(task["artists"])} artists in {self.count} shards')
+
+        processes = []
+        if self.local:
+            context = multiprocessing.get_context('spawn')
+            for index in range(self.count):
+                process = context.Process(target=run, args=(self.directory, index, self.count), daemon=True)
+                process.start()
+                processes.append(process)
+        results = None
+        try:
+            results = await self.collect(task['id'], processes)
+        finally:
+            if results is None:
+                # We crawl them ourselves now, whatever the others still do would only take from the rate limit.
+                for process in processes:
+                    if process.is_alive():
+                        process.terminate()
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*[loop.run_in_executor(None, process.join, 5) for process in processes])
+        if results is None:
+            return None
+        return self.merge(recentlier, results)
+
+    async def collect(self, id: str, processes: list) -> Optional[list]:
+        paths = [self.path(f'{id}-{index}') for index in range(self.count)]
+        deadline = time.monotonic() + self.timeout
+        while not all(os.path.exists(path) for path in paths):
+            dead = [index for index, process in enumerate(processes) if not (process.is_alive() or os.path.exists(paths[index]))]
+            if dead:
+                log(f'Shard {dead[0]} of {self.count} died, see {self.directory}/shard-{dead[0]}.log')
+                return None
+            if time.monotonic() > deadline:
+                missing = [index for index, path in enumerate(paths) if not os.path.exists(path)]
+                log(f'Gave up waiting for shards {missing} of {self.count}')
+                return None
+            await asyncio.sleep(0.1)
+
+        results = [load(path) for path in paths]
+        for path in paths:
+            os.remove(path)
+        for index, result in enumerate(results):
+            if 'error' in result:
+                log(f'Shard {index} of {self.count} failed -> Error {result["error"]}')
+                return None
+        return results
+
+    def merge(self, recentlier, results: list) -> Index:
+        '''Puts the albums in the order a single process would have found them in'''
+        for result in results:
+            recentlier.Marks.update(result['marks'])
+            recentlier.resynced = max(recentlier.resynced, result['resynced'])
+            recentlier.catalog.fetched.update(result['tracks'])
+            for (name, label), value in result['metrics'].items():
+                metrics.count(name, label, value)
+
+        Albums = Index()
+        for artist in recentlier.Artists:
+            result = results[shard(artist.id, self.count)]
+            mark = result['marks'].get(artist.id)
+            if not mark:
+                continue
+            dropped = set(mark.get('dropped', ()))
+            for album_id in mark['albums']:
+                if album_id not in dropped and album_id not in Albums:
+                    Albums.append(result['albums'][album_id])
+        return Albums
+
+
+async def work(recentlier, task: dict, index: int) -> dict:
+    '''Crawls the albums of one shard of the artists in `task`, and the tracks of those that are new or changed'''
+    count = task['count']
+    metrics.reset()
+    recentlier.Artists = task['artists']
+    recentlier.Albums = task['albums']
+    recentlier.Marks = dict(task['marks'])
+    recentlier.resynced = task['resynced']
+    artists = Index([artist for artist in recentlier.Artists if shard(artist.id, count) == index])
+    log(f'Shard {index} of {count}: {len(artists)} artists')
+
+    known = {album.id: album.fingerprint() for album in recentlier.Albums}
+    albums = await recentlier.populate_albums(artists)
+    full = task['full'] or recentlier.resynced != task['resynced']
+    ids = [album.id for album in albums if full or known.get(album.id) != album.fingerprint()]
+
+    tracks = {}
+    for found in await asyncio.gather(*[recentlier.get_album_tracks(ids[i : i + 20]) for i in range(0, len(ids), 20)]):
+        tracks.update(found)
+    log(f'Shard {index} of {count}: {len(albums)} albums, tracks of {len(tracks)} fetched')
+
+    return {
+        'albums': albums,
+        # populate_albums makes a new mark for every artist it has albums for.
+        'marks': {i: mark for i, mark in recentlier.Marks.items() if mark is not task['marks'].get(i)},
+        'resynced': recentlier.resynced,
+        'tracks': tracks,
+        'metrics': dict(metrics.counters),
+    }
+
+
+def worker(directory: str, index: int, count: int):
+    '''A Recentlier for a worker, it logs to its own file'''
+    from recentlier.main import Recentlier
+
+    # The rate limit is per application, every worker gets its share of it. Before the Recentlier, the
+    # profiles copy the config and the first of them builds the Scheduler.
+    config = Spotify.config
+    config.rate_limit /= count
+    logger.configure(os.path.join(directory, f'shard-{index}.log'), logger.level, config.log_max_bytes, config.log_backups)
+    return Recentlier()
+
+
+def run(directory: str, index: int, count: int) -> None:
+    '''Runs the current task of shard `index`, in a process the coordinator started'''
+    sys.stdout = open(os.devnull, 'w')
+    recentlier = worker(directory, index, count)
+    task = load(os.path.join(directory, 'task.pickle'))
+    dump(os.path.join(directory, f'{task["id"]}-{index}.pickle'), asyncio.run(work(recentlier, task, index)))
+    logger.flush()
+
+
+def serve(index: int, count: int) -> None:
+    '''Runs every task of shard `index` the coordinator hands out, for a worker on another machine'''
+    directory = Spotify.config.shard_dir
+    recentlier = worker(directory, index, count)
+    log(f'Waiting for tasks for shard {index} of {count} in {directory}')
+
+    async def loop() -> None:
+        path = os.path.join(directory, 'task.pickle')
+        done = stamp = None
+        while True:
+            try:
+                # Only read again once the coordinator wrote a new task.
+                task = None
+                if os.stat(path).st_mtime_ns != stamp:
+                    stamp = os.stat(path).st_mtime_ns
+                    task = load(path)
+            except (OSError, EOFError, pickle.UnpicklingError):
+                task = None
+            if not task or task['id'] == done or task['count'] != count:
+                await asyncio.sleep(1)
+                continue
+            try:
+                result = await work(recentlier, task, index)
+            except Exception as R:
+                log(f'Shard {index} of {count} failed -> Error {R}')
+                result = {'error': str(R)}
+            dump(os.path.join(directory, f'{task["id"]}-{index}.pickle'), result)
+            done = task['id']
+
+    asyncio.run(loop())
@@ -1,21 +1,264 @@
-import spotipy
+from __future__ import annotations
+
+import asyncio
+import functools
+import random
+import re
+import requests
 import sys
+import time
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib.parse import parse_qs, urlencode, urlparse
+
+from recentlier.metrics import metrics
+from recentlier.store import ResponseCache
+from recentlier.util import Config, Shared, lazy, log
+
+# spotipy pulls in redis and takes a while to import, nothing needs it before the first request.
+spotipy = lazy('spotipy')
+
+
+class Incomplete(Exception):
+    '''A page after the first one couldnt be fetched, what was paged through so far is only part of it'''
+
+
+class Scheduler:
+    '''Paces every request to the API.
 
-from spotipy import SpotifyException
-from spotipy.util import prompt_for_user_token
-from recentlier.util import Config, log
+    A token bucket spreads requests out to `rate` per second, a 429 pauses everyone until its
+    Retry-After has passed, and the number of requests in flight follows AIMD: it is halved when
+    we get throttled and grows by one for every `limit` successful requests, up to `maximum`.'''
 
-global config
-config = Config()
+    def __init__(self, rate: float, maximum: int) -> None:
+        self.rate = rate
+        self.tokens = max(1.0, rate)
+        self.updated = time.monotonic()
+        self.maximum = maximum
+        self.limit = maximum
+        self.active = 0
+        self.successes = 0
+        self.paused_until = 0.0
+        self.condition = asyncio.Condition()
+
+    async def acquire(self) -> None:
+        '''Waits for a free slot and a token'''
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.active < self.limit)
+            self.active += 1
+
+        try:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+
+                self.tokens = min(max(1.0, self.rate), self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+        except asyncio.CancelledError:
+            # A prefetched page nobody wants anymore, give its slot back.
+            await self.release()
+            raise
+
+    async def release(self) -> None:
+        async with self.condition:
+            self.active -= 1
+            self.condition.notify_all()
+
+    def success(self) -> None:
+        '''Additive increase, once per window of `limit` successful requests'''
+        self.successes += 1
+        if self.successes >= self.limit and self.limit < self.maximum:
+            self.limit += 1
+            self.successes = 0
+
+    def throttle(self, delay: float) -> None:
+        '''Multiplicative decrease, and hold every request back for `delay` seconds'''
+        self.limit = max(1, self.limit // 2)
+        self.successes = 0
+        self.paused_until = max(self.paused_until, time.monotonic() + delay)
+
+    @staticmethod
+    def backoff(attempt: int, base: float = 0.5, cap: float = 30.0) -> float:
+        '''Exponential backoff with full jitter'''
+        return random.uniform(0, min(cap, base * 2**attempt))
+
+
+class Session(requests.Session):
+    '''The one HTTP session of the process, every client and every token uses it.
+
+    Its pool keeps a connection alive for every request that can be in flight, so a crawl
+    opens `size` connections and reuses them from there on. Retries are left to the Scheduler
+    and not to urllib3. requests already asks for gzip and keep-alive.'''
+
+    def __init__(self, size: int) -> None:
+        super().__init__()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=size, max_retries=0)
+        self.mount('https://', adapter)
+        self.mount('http://', adapter)
+        self.hooks['response'].append(lambda response, *args, **kw: metrics.count('bytes', value=len(response.content)))
+
+    def close(self) -> None:
+        '''spotipy closes the session of a client it throws away, this one outlives them'''
+
+    def connections(self) -> tuple:
+        '''The connections opened and the requests sent since the session was made'''
+        opened = sent = 0
+        for adapter in set(self.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for pool in filter(None, map(pools.get, pools.keys())):
+                opened += pool.num_connections
+                sent += pool.num_requests
+        return opened, sent
+
+
+class CachedSession(Session):
+    '''A Session that answers GETs of the album endpoints from a ResponseCache.
+
+    A response younger than the ttl of its endpoint is served without a request. An older one
+    is asked for with If-None-Match, and when the API answers 304 the stored body is served.'''
+
+    endpoints = {
+        'artist_albums': re.compile(r'/artists/[^/]+/albums$'),
+        'albums': re.compile(r'/albums/?$'),
+        'album_tracks': re.compile(r'/albums/[^/]+/tracks$'),
+    }
+
+    def __init__(self, size: int, cache: ResponseCache, ttl: dict) -> None:
+        super().__init__(size)
+        self.cache = cache
+        self.ttl = ttl
+
+    def endpoint(self, url: str):
+        path = urlparse(url).path
+        return next((name for name, pattern in self.endpoints.items() if pattern.search(path)), None)
+
+    def request(self, method, url, params=None, headers=None, **kwargs) -> requests.Response:
+        endpoint = self.endpoint(url) if method == 'GET' else None
+        if endpoint is None:
+            return super().request(method, url, params=params, headers=headers, **kwargs)
+
+        # Keyed on the url with its query, and never on the token, these endpoints are the same for everyone.
+        key = requests.Request(method, url, params=params).prepare().url
+        ttl = float(self.ttl.get(endpoint, 0)) * 60
+        entry = self.cache.get(key)
+        if entry:
+            etag, body, stored = entry
+            if time.time() - stored < ttl:
+                metrics.count('cache_hits', 'http')
+                return self.replay(key, body)
+            if etag:
+                headers = dict(headers or {}, **{'If-None-Match': etag})
+
+        response = super().request(method, url, params=params, headers=headers, **kwargs)
+        if response.status_code == 304 and entry:
+            metrics.count('cache_hits', 'http')
+            self.cache.touch(key)
+            return self.replay(key, entry[1])
+
+        metrics.count('cache_misses', 'http')
+        etag = response.headers.get('ETag')
+        if response.status_code == 200 and (etag or ttl):
+            self.cache.put(key, etag, response.content)
+        return response
+
+    @staticmethod
+    def replay(url: str, body: bytes) -> requests.Response:
+        response = requests.Response()
+        response.status_code = 200
+        response.url = url
+        response.encoding = 'utf-8'
+        response.headers['Content-Type'] = 'application/json'
+        response._content = body
+        return response
+
+
+class Tokens:
+    '''Keeps the access token of one user valid, instead of waiting for a request to be refused.
+
+    The token is refreshed with its refresh token once it expires within `margin` seconds.
+    The first caller does that, and everyone else waits for it. spotipy keeps the token in
+    .cache-<username>, like prompt_for_user_token did. Logging in again is only asked for
+    when `interactive`, which the daemon is at startup and never while it crawls.'''
+
+    def __init__(self, config: Config, margin: float = 60) -> None:
+        self.config = config
+        self.margin = margin
+        self.oauth = None
+        self.token = None
+        self.lock = asyncio.Lock()
+
+    def fresh(self) -> bool:
+        return bool(self.token) and self.token['expires_at'] - self.margin > time.time()
+
+    async def get(self, interactive: bool = False) -> str:
+        if not self.fresh():
+            async with self.lock:
+                # Someone else may have refreshed it while we waited.
+                if not self.fresh():
+                    self.token = await asyncio.get_running_loop().run_in_executor(None, self.renew, interactive)
+        return self.token['access_token']
+
+    def expire(self, access_token: str) -> bool:
+        '''The API refused `access_token`, the next get() refreshes it unless that happened already'''
+        if self.token and self.token['access_token'] == access_token and self.fresh():
+            self.token = dict(self.token, expires_at=0)
+            return True
+        return False
+
+    def renew(self, interactive: bool) -> dict:
+        '''The cached token if it is still fresh, or a refreshed one. Blocks, so it runs on a worker thread.'''
+        config = self.config
+        if self.oauth is None:
+            self.oauth = spotipy.SpotifyOAuth(
+                config.client_id, config.client_secret, config.callback, scope=','.join(config.scope), username=config.username
+            )
+        token = self.token or self.oauth.cache_handler.get_cached_token()
+        if token and token['expires_at'] - self.margin > time.time():
+            return token
+
+        if token and token.get('refresh_token'):
+            try:
+                token = self.oauth.refresh_access_token(token['refresh_token'])
+                log(f'Refreshed the token of {config.username}')
+                return token
+            except (spotipy.SpotifyOauthError, requests.exceptions.RequestException) as R:
+                log(f'Couldnt refresh the token of {config.username} -> Error {R}')
+                if token['expires_at'] > time.time():
+                    return token
+
+        if not interactive:
+            raise Exception(f'There is no valid token for {config.username}, restart me to log in again.')
+        self.oauth.get_access_token(self.oauth.get_auth_response(), as_dict=False)
+        log('New token retrieved')
+        return self.oauth.cache_handler.get_cached_token()
 
 
 class Spotify:
-    config = Config()
+    # Read from config.json on first use, and the same Config for every client after that.
+    config = Shared(Config)
+    # A fixed token instead of OAuth, the benchmark sets one.
     token = None
+    tokens = None
+    # The token self.sp has.
+    auth = None
     sp = None
+    # Overrides the Web API base url, the benchmark points this at bench.fakeapi.
+    prefix = None
+    pool = None
+    scheduler = None
+    # The Session every client shares, see session().
+    http = None
 
-    async def exceptionhandler(self, e: SpotifyException) -> bool:
-        '''Tries to handle exceptions'''
+    async def exceptionhandler(self, e: spotipy.SpotifyException, attempt: int = 0) -> bool:
+        '''Tries to handle exceptions, returns True if the request should be retried'''
 
         if e.http_status == 401:
             # No token was provided.
@@ -23,12 +266,28 @@ class Spotify:
                 log('You need to update your config before running me.')
                 sys.exit(0)
 
-            if e.msg.split('\n')[1] == 'The access token expired':
-                # Token expired.
-                log('Access token expired.')
-                del self.token
-                await self.get_token()
+            if e.msg.split('\n')[1].strip() == 'The access token expired' and self.tokens:
+                # Expired sooner than it said, the retry gets a new one.
+                if self.tokens.expire(self.auth):
+                    log('Access token expired.')
+
+            return True
 
+        if e.http_status == 429:
+            # Rate limited, Spotify tells us how long to back off for.
+            try:
+                delay = float((e.headers or {}).get('Retry-After'))
+            except (TypeError, ValueError):
+                delay = self.scheduler.backoff(attempt)
+            log(f'Rate limited, backing off for {delay:.1f}s (limit {self.scheduler.limit})', silent=not self.config.verbose)
+            metrics.count('throttled')
+            self.scheduler.throttle(delay)
+            return True
+
+        if e.http_status >= 500:
+            delay = self.scheduler.backoff(attempt)
+            log(f'Server error {e.http_status}, retrying in {delay:.1f}s', silent=not self.config.verbose)
+            await asyncio.sleep(delay)
             return True
 
         if e.http_status == 404:
@@ -36,194 +295,207 @@ class Spotify:
             if e.msg.split('\n')[1] == ' non existing id':
                 log('The request failed, and says this id doesnt exist in this context.')
                 log(e.msg.split('\n')[0])
-        # TODO:
-        # Complete this method
-
-        print(e.http_status)
-        print(e.reason)
-        print(e.args)
-        print(e.code)
-        print(e.headers)
-        print(e.msg)
+                return False
 
+        log(f'Request failed with {e.http_status}: {e.msg}')
         return False
 
-    async def get_token(self) -> spotipy.client:
-        '''Retrieves a workable token'''
-
-        token = prompt_for_user_token(
-            username=config.username,
-            scope=','.join(i for i in config.scope),
-            client_secret=config.client_secret,
-            client_id=config.client_id,
-            redirect_uri=config.callback,
-        )
-
-        if token:
-            # Successfully retrieved token!
-            self.token = token
-            log('New token retrieved')
-
-            return token
-        else:
-            log('Unable to retrieve token!')
-            return None
+    async def get_token(self, interactive: bool = False) -> str:
+        '''A token that stays valid for a while yet, see Tokens'''
+        if self.token:
+            return self.token
+        if self.tokens is None:
+            self.tokens = Tokens(self.config)
+        return await self.tokens.get(interactive)
 
     async def client(self) -> spotipy.Spotify:
         '''Returns the spotify Client.'''
 
-        if not self.token:
-            await self.get_token()
-
+        config = self.config
+        self.auth = await self.get_token()
+        self.sp = spotipy.Spotify(
+            auth=self.auth, requests_session=self.session(), requests_timeout=(config.connect_timeout, config.read_timeout)
+        )
+        if self.prefix:
+            self.sp.prefix = self.prefix
+        return self.sp
+
+    def pace(self) -> None:
+        '''Starts the worker pool and the Scheduler, once'''
+        if not self.pool:
+            self.pool = ThreadPoolExecutor(max_workers=self.config.concurrency, thread_name_prefix='spotify')
+            self.scheduler = Scheduler(self.config.rate_limit, self.config.concurrency)
+
+    def user(self, config: Config):
+        '''A client for the user of `config`, with its own token.
+
+        It shares our workers and Scheduler, the rate limit is per application and not per user.'''
+        self.pace()
+        spotify = type(self)()
+        spotify.config = config
+        spotify.pool, spotify.scheduler = self.pool, self.scheduler
+        return spotify
+
+    def session(self) -> Session:
+        '''The Session of the process, made on first use. A CachedSession when http_cache.file is set.'''
+        if Spotify.http is None:
+            config = self.config
+            if config.http_cache_file:
+                cache = ResponseCache(config.http_cache_file, int(config.http_cache_max_mb * 1_000_000))
+                Spotify.http = CachedSession(config.concurrency, cache, config.http_cache_ttl)
+            else:
+                Spotify.http = Session(config.concurrency)
+        return Spotify.http
+
+    @classmethod
+    def connections(cls) -> tuple:
+        '''See Session.connections'''
+        return cls.http.connections() if cls.http else (0, 0)
+
+    async def request(self, method: str, *args, **kwargs):
+        '''Runs a blocking spotipy call on the worker pool, paced by the Scheduler.
+
+        Returns None if the request failed and could not be retried.'''
+
+        self.pace()
+        for attempt in range(self.config.retries + 1):
+            if not self.sp:
+                await self.client()
+            elif (token := await self.get_token()) != self.auth:
+                self.auth = token
+                self.sp.set_auth(token)
+
+            call = functools.partial(getattr(self.sp, method), *args, **kwargs)
+            await self.scheduler.acquire()
+            metrics.count('requests', method)
+            try:
+                result = await asyncio.get_running_loop().run_in_executor(self.pool, call)
+            except spotipy.SpotifyException as R:
+                retry = await self.exceptionhandler(R, attempt)
+            except requests.exceptions.RequestException as R:
+                # Connection errors and timeouts are treated like a 5xx.
+                delay = self.scheduler.backoff(attempt)
+                log(f'{type(R).__name__} on {method}, retrying in {delay:.1f}s', silent=not self.config.verbose)
+                await asyncio.sleep(delay)
+                retry = True
+            else:
+                self.scheduler.success()
+                return result
+            finally:
+                await self.scheduler.release()
+
+            if not retry:
+                return None
+            metrics.count('retries', method)
+
+        log(f'Giving up on {method} after {self.config.retries} retries')
+        return None
+
+    async def pages(self, first: dict, key: str = None, eager: bool = True):
+        '''Yields `first` and every page after it in order, unwrapped from `key` if given.
+
+        When the first page tells the total and pages by offset, every page after it is
+        fetched right away, paced by the Scheduler like any request. Otherwise, like the cursor
+        paged followed artists, the next page is fetched while the caller works on this one.
+        With `eager` off a page is only fetched once it is asked for, for callers that stop
+        early. A page that fails after its retries raises Incomplete.'''
+        page = first[key] if key else first
+        urls = self.offsets(page) if eager else None
+        pending = deque(asyncio.ensure_future(self.next({'next': url})) for url in urls or ())
         try:
-            self.sp = spotipy.Spotify(auth=self.token)
-
-        except SpotifyException as R:
-            success = self.exceptionhandler(R)
-            if success:
-                self.client()
-
-                return True
-
-        return False
+            while page:
+                if urls is None and eager and page.get('next'):
+                    pending.append(asyncio.ensure_future(self.next(page)))
+                yield page
+                if pending:
+                    result = await pending.popleft()
+                elif urls is None and page.get('next'):
+                    result = await self.next(page)
+                else:
+                    return
+                if not result:
+                    raise Incomplete(f'Couldnt fetch the page after {page.get("href") or page.get("next")}')
+                page = result[key] if key else result
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def items(self, first: dict, key: str = None, eager: bool = True):
+        '''Yields the items of every page, see pages()'''
+        async for page in self.pages(first, key, eager):
+            for item in page['items']:
+                yield item
+
+    @staticmethod
+    def offsets(page: dict):
+        '''The urls of every page after `page`, or None if it doesnt page by offset or tell the total'''
+        if not page.get('next') or page.get('total') is None:
+            return None
+        url = urlparse(page['next'])
+        query = parse_qs(url.query)
+        if 'offset' not in query:
+            return None
+        limit = int(query['limit'][0]) if 'limit' in query else len(page['items'])
+        if limit < 1:
+            return None
+        return [
+            url._replace(query=urlencode(dict(query, offset=[offset]), doseq=True)).geturl()
+            for offset in range(int(query['offset'][0]), page['total'], limit)
+        ]
 
     async def next(self, *args, **kwargs) -> spotipy.Spotify.next:
-        if not self.sp:
-            await self.client()
-
-        try:
-            return self.sp.next(*args, **kwargs)
-        except SpotifyException as R:
-            success = await self.exceptionhandler(R)
-            if success:
-                await self.next(*args, **kwargs)
+        return await self.request('next', *args, **kwargs)
 
     async def get_artists(self, *args, **kwargs) -> spotipy.Spotify.current_user_followed_artists:
-        if not self.sp:
-            await self.client()
-        try:
-            return self.sp.current_user_followed_artists(*args, **kwargs)
-        except SpotifyException as R:
-            success = await self.exceptionhandler(R)
-            if success:
-                await self.get_artists(*args, **kwargs)
+        return await self.request('current_user_followed_artists', *args, **kwargs)
 
     async def artist_albums(self, *args, **kwargs) -> spotipy.Spotify.artist_albums:
-        if not self.sp:
-            await self.client()
-        try:
-            return self.sp.artist_albums(*args, **kwargs)
-        except SpotifyException as R:
-            success = await self.exceptionhandler(R)
-            if success:
-                await self.artist_albums(*args, **kwargs)
+        return await self.request('artist_albums', *args, **kwargs)
 
     async def get_album(self, *args, **kwargs) -> spotipy.Spotify.album_tracks:
-        if not self.sp:
-            await self.client()
-        try:
-            return self.sp.album_tracks(*args, **kwargs)
-        except SpotifyException as R:
-            success = await self.exceptionhandler(R)
-            if success:
-                await self.get_album(*args, **kwargs)
+        return await self.request('album_tracks', *args, **kwargs)
 
     async def get_several_albums(self, *args, **kwargs) -> spotipy.Spotify.albums:
-        if not self.sp:
-            await self.client()
-        try:
-            return self.sp.albums(*args, **kwargs)
-        except SpotifyException as R:
-            success = await self.exceptionhandler(R)
-            if success:
-                await self.get_several_albums(*args, **kwargs)
+        return await self.request('albums', *args, **kwargs)
 
     async def me(self, *args, **kwargs) -> spotipy.Spotify.me:
-        if not self.sp:
-            await self.client()
-        try:
-            return self.sp.me(*args, **kwargs)
-        except SpotifyException as R:
-            success = await self.exceptionhandler(R)
-            if success:
-                await self.me(*args, **kwargs)
+        return await self.request('me', *args, **kwargs)
 
     async def playlists(self, *args, **kwargs) -> spotipy.Spotify.user_playlists:
-        if not self.sp:
-            await self.client()
-        try:
-            return self.sp.user_playlists(*args, **kwargs)
-        except SpotifyException as R:
-            success = await self.exceptionhandler(R)
-            if success:
-                await self.playlists(*args, **kwargs)
+        return await self.request('user_playlists', *args, **kwargs)
 
     async def playlist(self, *args, **kwargs) -> spotipy.Spotify.user_playlist:
-        if not self.sp:
-            await self.client()
-        try:
-            return self.sp.user_playlist(*args, **kwargs)
-        except SpotifyException as R:
-            success = await self.exceptionhandler(R)
-            if success:
-                await self.playlist(*args, **kwargs)
+        return await self.request('user_playlist', *args, **kwargs)
 
     async def create_playlist(self, *args, **kwargs) -> spotipy.Spotify.user_playlist_create:
-        if not self.sp:
-            await self.client()
-        try:
-            return self.sp.user_playlist_create(*args, **kwargs)
-        except SpotifyException as R:
-            success = await self.exceptionhandler(R)
-            if success:
-                await self.create_playlist(*args, **kwargs)
+        return await self.request('user_playlist_create', *args, **kwargs)
 
     async def playlist_tracks(self, *args, **kwargs) -> spotipy.Spotify.playlist_tracks:
-        if not self.sp:
-            await self.client()
-        try:
-            return self.sp.playlist_tracks(*args, **kwargs)
-        except SpotifyException as R:
-            success = await self.exceptionhandler(R)
-            if success:
-                await self.playlist_tracks(*args, **kwargs)
+        return await self.request('playlist_tracks', *args, **kwargs)
 
     async def add_tracks(self, *args, **kwargs) -> spotipy.Spotify.user_playlist_replace_tracks:
-        if not self.sp:
-            await self.client()
-        try:
-            return self.sp.user_playlist_replace_tracks(*args, **kwargs)
-        except SpotifyException as R:
-            success = await self.exceptionhandler(R)
-            if success:
-                await self.add_tracks(*args, **kwargs)
+        return await self.request('user_playlist_replace_tracks', *args, **kwargs)
 
     async def remove_playlist_tracks(self, *args, **kwargs) -> spotipy.Spotify.user_playlist_remove_all_occurrences_of_tracks:
-        if not self.sp:
-            await self.client()
-        try:
-            return self.sp.user_playlist_remove_all_occurrences_of_tracks(*args, **kwargs)
-        except SpotifyException as R:
-            success = await self.exceptionhandler(R)
-            if success:
-                await self.remove_playlist_tracks(*args, **kwargs)
+        return await self.request('user_playlist_remove_all_occurrences_of_tracks', *args, **kwargs)
+
+    async def playlist_items(self, *args, **kwargs) -> spotipy.Spotify.playlist_items:
+        return await self.request('playlist_items', *args, **kwargs)
+
+    async def add_playlist_items(self, *args, **kwargs) -> spotipy.Spotify.playlist_add_items:
+        return await self.request('playlist_add_items', *args, **kwargs)
+
+    async def remove_playlist_items(self, *args, **kwargs) -> spotipy.Spotify.playlist_remove_all_occurrences_of_items:
+        return await self.request('playlist_remove_all_occurrences_of_items', *args, **kwargs)
+
+    async def reorder_playlist_items(self, *args, **kwargs) -> spotipy.Spotify.playlist_reorder_items:
+        return await self.request('playlist_reorder_items', *args, **kwargs)
+
+    async def replace_playlist_items(self, *args, **kwargs) -> spotipy.Spotify.playlist_replace_items:
+        return await self.request('playlist_replace_items', *args, **kwargs)
 
     async def tracks(self, *args, **kwargs) -> spotipy.Spotify.tracks:
-        if not self.sp:
-            await self.client()
-        try:
-            return self.sp.tracks(*args, **kwargs)
-        except SpotifyException as R:
-            success = await self.exceptionhandler(R)
-            if success:
-                await self.tracks(*args, **kwargs)
+        return await self.request('tracks', *args, **kwargs)
 
     async def playlist_details(self, *args, **kwargs) -> spotipy.Spotify.playlist_change_details:
-        if not self.sp:
-            await self.client()
-        try:
-            return self.sp.playlist_change_details(*args, **kwargs)
-        except SpotifyException as R:
-            success = await self.exceptionhandler(R)
-            if success:
-                await self.playlist_details(*args, **kwargs)
+        return await self.request('playlist_change_details', *args, **kwargs)
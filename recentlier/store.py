@@ -0,0 +1,216 @@
+import json
+import pickle
+import sqlite3
+import threading
+import time
+import zlib
+
+from recentlier.classes import Album, Artist, Track
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS artists (id TEXT PRIMARY KEY, name TEXT);
+CREATE TABLE IF NOT EXISTS albums (id TEXT PRIMARY KEY, name TEXT, release_date TEXT, artist_id TEXT, artist_name TEXT);
+CREATE INDEX IF NOT EXISTS albums_release_date ON albums (release_date);
+CREATE TABLE IF NOT EXISTS tracks (
+    id TEXT PRIMARY KEY, name TEXT, release_date TEXT, duration INTEGER, artist_id TEXT, artist_name TEXT, album_id TEXT,
+    artist_ids TEXT
+);
+CREATE INDEX IF NOT EXISTS tracks_release_date ON tracks (release_date);
+CREATE TABLE IF NOT EXISTS marks (
+    id TEXT PRIMARY KEY, total INTEGER, release_date TEXT, albums TEXT, checked REAL, dropped TEXT, filter TEXT
+);
+CREATE TABLE IF NOT EXISTS meta (id TEXT PRIMARY KEY, value BLOB);
+'''
+
+
+class SQLiteStore:
+    '''Keeps the cache in SQLite, and only writes the rows that changed since the last write.'''
+
+    columns = {
+        'artists': ('id', 'name'),
+        'albums': ('id', 'name', 'release_date', 'artist_id', 'artist_name'),
+        'tracks': ('id', 'name', 'release_date', 'duration', 'artist_id', 'artist_name', 'album_id', 'artist_ids'),
+        'marks': ('id', 'total', 'release_date', 'albums', 'checked', 'dropped', 'filter'),
+        'meta': ('id', 'value'),
+    }
+    classes = {'artists': Artist, 'albums': Album, 'tracks': Track}
+
+    def __init__(self, path: str = 'cache.sqlite') -> None:
+        self.path = path
+        # Written from the cache thread, and never by two threads at once.
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.executescript(SCHEMA)
+        self.migrate()
+        # What the database holds right now, per table: id -> row.
+        self.rows = {table: {} for table in self.columns}
+        self.version = self.data_version()
+
+    def migrate(self) -> None:
+        '''Adds the columns that stores made by older versions dont have'''
+        for table, columns in self.columns.items():
+            existing = {row[1] for row in self.db.execute(f'PRAGMA table_info({table})')}
+            for column in columns:
+                if column not in existing:
+                    self.db.execute(f'ALTER TABLE {table} ADD COLUMN {column}')
+
+    def data_version(self) -> int:
+        return self.db.execute('PRAGMA data_version').fetchone()[0]
+
+    def changed(self) -> bool:
+        '''Wether another process wrote to the database since we loaded it'''
+        return self.data_version() != self.version
+
+    def empty(self) -> bool:
+        return self.db.execute('SELECT 1 FROM artists LIMIT 1').fetchone() is None
+
+    def select(self, table: str, query: str = '', *args) -> list:
+        columns = ', '.join(self.columns[table])
+        return self.db.execute(f'SELECT {columns} FROM {table} {query}', args).fetchall()
+
+    def load(self) -> list:
+        '''Reads the whole store, in the same shape as the pickled cache'''
+        data = []
+        for table, cls in self.classes.items():
+            rows = self.select(table, 'ORDER BY rowid')
+            self.rows[table] = {row[0]: row for row in rows}
+            data.append([cls.create(**dict(zip(self.columns[table], row))) for row in rows])
+
+        rows = self.select('marks', 'ORDER BY rowid')
+        self.rows['marks'] = {row[0]: row for row in rows}
+        marks = {
+            row[0]: {
+                'total': row[1],
+                'release_date': row[2],
+                'albums': json.loads(row[3]),
+                'checked': row[4] or 0,
+                'dropped': json.loads(row[5] or '[]'),
+                'filter': json.loads(row[6] or 'null'),
+            }
+            for row in rows
+        }
+
+        rows = self.select('meta')
+        self.rows['meta'] = {row[0]: row for row in rows}
+        meta = {row[0]: pickle.loads(row[1]) for row in rows}
+
+        self.version = self.data_version()
+        return data + [meta.get('playlist'), marks, meta.get('resynced', 0), meta.get('profiles', {}), meta.get('duplicates', {})]
+
+    def write(self, data: dict) -> int:
+        '''Upserts changed rows and deletes removed ones in one transaction, returns the number of rows touched.
+
+        `data` is a Cache.snapshot().'''
+        changed = 0
+        with self.db:
+            for table in ('artists', 'albums', 'tracks'):
+                columns = self.columns[table]
+                changed += self.sync(table, {obj.id: tuple(getattr(obj, i) for i in columns) for obj in data[table]})
+
+            changed += self.sync(
+                'marks',
+                {
+                    artist_id: (
+                        artist_id,
+                        mark['total'],
+                        mark['release_date'],
+                        json.dumps(mark['albums']),
+                        mark.get('checked', 0),
+                        json.dumps(mark.get('dropped', [])),
+                        json.dumps(mark.get('filter')),
+                    )
+                    for artist_id, mark in data['marks'].items()
+                },
+            )
+            changed += self.sync(
+                'meta',
+                {
+                    'playlist': ('playlist', pickle.dumps(data['playlist'], protocol=pickle.HIGHEST_PROTOCOL)),
+                    'resynced': ('resynced', pickle.dumps(data['resynced'])),
+                    'profiles': ('profiles', pickle.dumps(data['profiles'], protocol=pickle.HIGHEST_PROTOCOL)),
+                    'duplicates': ('duplicates', pickle.dumps(data['duplicates'], protocol=pickle.HIGHEST_PROTOCOL)),
+                },
+            )
+        return changed
+
+    def sync(self, table: str, rows: dict) -> int:
+        old = self.rows[table]
+        upserts = [row for _id, row in rows.items() if old.get(_id) != row]
+        deletes = [(_id,) for _id in old.keys() - rows.keys()]
+
+        columns = self.columns[table]
+        updates = ', '.join(f'{i} = excluded.{i}' for i in columns[1:])
+        self.db.executemany(
+            f'INSERT INTO {table} ({", ".join(columns)}) VALUES ({", ".join("?" * len(columns))}) '
+            f'ON CONFLICT (id) DO UPDATE SET {updates}',
+            upserts,
+        )
+        self.db.executemany(f'DELETE FROM {table} WHERE id = ?', deletes)
+
+        self.rows[table] = rows
+        return len(upserts) + len(deletes)
+
+    def compact(self) -> None:
+        '''Folds the write-ahead log into the database and gives back unused pages'''
+        self.db.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        self.db.execute('VACUUM')
+
+
+class ResponseCache:
+    '''HTTP responses in SQLite by url, with the ETag they came with.
+
+    Bodies are kept compressed, and once they add up to more than `max_bytes` the least
+    recently used ones are dropped. Shared by every session, so it locks itself.'''
+
+    def __init__(self, path: str = 'http.sqlite', max_bytes: int = 100_000_000) -> None:
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.executescript(
+            '''
+            CREATE TABLE IF NOT EXISTS responses (
+                url TEXT PRIMARY KEY, etag TEXT, body BLOB, stored REAL, used REAL, size INTEGER
+            );
+            CREATE INDEX IF NOT EXISTS responses_used ON responses (used);
+            '''
+        )
+        self.size = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+    def get(self, url: str):
+        '''(etag, body, stored) of `url` or None, and marks it as used'''
+        with self.lock, self.db:
+            row = self.db.execute('SELECT etag, body, stored FROM responses WHERE url = ?', (url,)).fetchone()
+            if row is None:
+                return None
+            self.db.execute('UPDATE responses SET used = ? WHERE url = ?', (time.time(), url))
+        return row[0], zlib.decompress(row[1]), row[2]
+
+    def put(self, url: str, etag: str, body: bytes) -> None:
+        data = zlib.compress(body, 1)
+        now = time.time()
+        with self.lock, self.db:
+            old = self.db.execute('SELECT size FROM responses WHERE url = ?', (url,)).fetchone()
+            self.db.execute(
+                'INSERT OR REPLACE INTO responses (url, etag, body, stored, used, size) VALUES (?, ?, ?, ?, ?, ?)',
+                (url, etag, data, now, now, len(data)),
+            )
+            self.size += len(data) - (old[0] if old else 0)
+            if self.size > self.max_bytes:
+                self.evict()
+
+    def touch(self, url: str) -> None:
+        '''The stored response was revalidated, it is fresh again'''
+        with self.lock, self.db:
+            self.db.execute('UPDATE responses SET stored = ? WHERE url = ?', (time.time(), url))
+
+    def evict(self) -> None:
+        '''Drops the least recently used responses, down to 90% of max_bytes so this doesnt run on every put'''
+        for url, size in self.db.execute('SELECT url, size FROM responses ORDER BY used').fetchall():
+            if self.size <= self.max_bytes * 0.9:
+                break
+            self.db.execute('DELETE FROM responses WHERE url = ?', (url,))
+            self.size -= size
@@ -1,12 +1,21 @@
+import asyncio
+import atexit
+import copy
+import glob
+import importlib.util
 import json
 import os
 import pickle
 import sys
+import threading
 import time
 import requests
 
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from datetime import datetime
+from recentlier.metrics import metrics
+from recentlier.store import SQLiteStore
 
 
 @dataclass
@@ -15,13 +24,58 @@ class Config:
     client_secret: str = 'changeme'
     client_id: str = 'changeme'
     scope = ["playlist-read-private", "user-follow-read", "playlist-modify-private", "playlist-modify-public"]
+    # [released within days, check every hours], the last tier is for everyone else.
+    refresh_tiers = [[30, 6], [365, 24], [None, 72]]
+    # Job name -> {"every": duration} or {"cron": expression}, with an optional "jitter" and "enabled".
+    jobs = {
+        'artists': {'every': '1h', 'jitter': '5m'},
+        'albums': {'every': '1h', 'jitter': '5m'},
+        'tracks': {'every': '6h'},
+        'playlist': {'every': '6h'},
+        'cache': {'cron': '30 4 * * *'},
+    }
+    # Minutes a cached response is used without asking, after that it is revalidated by its ETag.
+    # New albums show up on artist_albums, so that one is always revalidated.
+    http_cache_ttl = {'artist_albums': 0, 'albums': 60, 'album_tracks': 60}
     callback: str = "http://127.0.0.1:8081"
     playlist_name: str = 'Recentlier2'
     playlist_size: int = 50
     playlist_id: str = None
+    playlist_precision: str = 'year'
     output: bool = True
     verbose: bool = False
     quitafter: bool = False
+    concurrency: int = 8
+    rate_limit: float = 20
+    retries: int = 5
+    connect_timeout: float = 5
+    read_timeout: float = 30
+    incremental: bool = True
+    full_resync: float = 168
+    cache_backend: str = 'pickle'
+    metrics_file: str = 'metrics.jsonl'
+    metrics_port: int = 0
+    schedule_port: int = 0
+    log_file: str = 'recentlier.log'
+    log_level: str = None
+    log_max_bytes: int = 10_000_000
+    log_backups: int = 3
+    profiles_dir: str = None
+    http_cache_file: str = 'http.sqlite'
+    http_cache_max_mb: float = 100
+    version_check: bool = True
+    # See classes.Filter, album groups and types are lists like ["album", "single"].
+    filter_groups: list = None
+    filter_types: list = None
+    filter_market: str = None
+    filter_min_duration: float = 0
+    filter_exclude: list = None
+    shards: int = 1
+    shard_dir: str = 'shards'
+    shard_local: bool = True
+    shard_timeout: float = 3600
+    # The name of the profile this config is for, see load_profile().
+    profile: str = None
 
     def __init__(self) -> None:
         '''Initialize the table if not already initialized'''
@@ -41,9 +95,45 @@ class Config:
                 self.playlist_name = self.data['playlist']['name']
                 self.playlist_size = self.data['playlist']['size']
                 self.playlist_id = self.data['playlist']['id']
+                self.playlist_precision = self.data['playlist'].get('precision', self.playlist_precision)
                 self.output = self.data['output']['on']
                 self.verbose = self.data['output']['verbose']
                 self.quitafter = self.data['application']['quit_after_update']
+                self.concurrency = int(self.data['application'].get('concurrency', self.concurrency))
+                self.rate_limit = float(self.data['application'].get('rate_limit', self.rate_limit))
+                self.retries = int(self.data['application'].get('retries', self.retries))
+                self.connect_timeout = float(self.data['application'].get('connect_timeout', self.connect_timeout))
+                self.read_timeout = float(self.data['application'].get('read_timeout', self.read_timeout))
+                self.incremental = self.data['application'].get('incremental', self.incremental)
+                self.full_resync = float(self.data['application'].get('full_resync_hours', self.full_resync))
+                self.version_check = self.data['application'].get('version_check', self.version_check)
+                self.refresh_tiers = self.data['application'].get('refresh_tiers', self.refresh_tiers)
+                self.cache_backend = self.data.get('cache', {}).get('backend', self.cache_backend)
+                self.metrics_file = self.data.get('metrics', {}).get('file', self.metrics_file)
+                self.metrics_port = int(self.data.get('metrics', {}).get('port') or 0)
+                self.schedule_port = int(self.data.get('schedule', {}).get('port') or 0)
+                self.jobs = {**self.jobs, **self.data.get('schedule', {}).get('jobs', {})}
+                self.log_file = self.data.get('log', {}).get('file', self.log_file)
+                self.log_level = self.data.get('log', {}).get('level', self.log_level)
+                self.log_max_bytes = int(self.data.get('log', {}).get('max_bytes', self.log_max_bytes))
+                self.log_backups = int(self.data.get('log', {}).get('backups', self.log_backups))
+                self.profiles_dir = self.data.get('profiles', {}).get('dir', self.profiles_dir)
+                self.http_cache_file = self.data.get('http_cache', {}).get('file', self.http_cache_file)
+                self.http_cache_max_mb = float(self.data.get('http_cache', {}).get('max_mb', self.http_cache_max_mb))
+                self.filter_groups = self.data.get('filter', {}).get('include_groups', self.filter_groups)
+                self.filter_types = self.data.get('filter', {}).get('album_types', self.filter_types)
+                self.filter_market = self.data.get('filter', {}).get('market', self.filter_market)
+                self.filter_min_duration = float(self.data.get('filter', {}).get('min_duration', self.filter_min_duration))
+                self.filter_exclude = self.data.get('filter', {}).get('exclude', self.filter_exclude)
+                self.shards = int(self.data.get('shards', {}).get('count', self.shards))
+                self.shard_dir = self.data.get('shards', {}).get('dir', self.shard_dir)
+                self.shard_local = self.data.get('shards', {}).get('local', self.shard_local)
+                self.shard_timeout = float(self.data.get('shards', {}).get('timeout', self.shard_timeout))
+                self.http_cache_ttl = {**self.http_cache_ttl, **self.data.get('http_cache', {}).get('ttl_minutes', {})}
+
+                # Per-object lines are debug lines, verbose turns them on unless a level is set.
+                level = LEVELS.get(str(self.log_level).lower(), DEBUG if self.verbose else INFO)
+                logger.configure(self.log_file, level, self.log_max_bytes, self.log_backups)
 
                 return self
         else:
@@ -66,10 +156,11 @@ class Config:
                             "callback": self.callback,
                         },
                         "playlist": {
-                            "_comment": "Playlist Information",
+                            "_comment": "Playlist Information, precision month or day leaves out less exact release dates",
                             "name": self.playlist_name,
                             "size": self.playlist_size,
                             "id": self.playlist_id,
+                            "precision": self.playlist_precision,
                         },
                         "output": {
                             "on": self.output,
@@ -78,6 +169,61 @@ class Config:
                         "application": {
                             "_comment": "Application Behaviour",
                             "quit_after_update": self.quitafter,
+                            "concurrency": self.concurrency,
+                            "rate_limit": self.rate_limit,
+                            "retries": self.retries,
+                            "connect_timeout": self.connect_timeout,
+                            "read_timeout": self.read_timeout,
+                            "incremental": self.incremental,
+                            "full_resync_hours": self.full_resync,
+                            "refresh_tiers": self.refresh_tiers,
+                            "version_check": self.version_check,
+                        },
+                        "cache": {
+                            "_comment": "pickle or sqlite",
+                            "backend": self.cache_backend,
+                        },
+                        "metrics": {
+                            "_comment": "json lines per cycle, and a Prometheus endpoint if port is set",
+                            "file": self.metrics_file,
+                            "port": self.metrics_port,
+                        },
+                        "schedule": {
+                            "_comment": "every job runs on its own trigger, send 'run [job]' or 'status' to port to run now",
+                            "port": self.schedule_port,
+                            "jobs": self.jobs,
+                        },
+                        "log": {
+                            "_comment": "level is debug, info, warning or error, null follows output.verbose",
+                            "file": self.log_file,
+                            "level": self.log_level,
+                            "max_bytes": self.log_max_bytes,
+                            "backups": self.log_backups,
+                        },
+                        "profiles": {
+                            "_comment": "a directory of profile files, one playlist per user from the same crawl",
+                            "dir": self.profiles_dir,
+                        },
+                        "http_cache": {
+                            "_comment": "album responses, revalidated by ETag after ttl_minutes, file null turns it off",
+                            "file": self.http_cache_file,
+                            "max_mb": self.http_cache_max_mb,
+                            "ttl_minutes": self.http_cache_ttl,
+                        },
+                        "filter": {
+                            "_comment": "null keeps everything, exclude is a list of regexes for album and track names",
+                            "include_groups": self.filter_groups,
+                            "album_types": self.filter_types,
+                            "market": self.filter_market,
+                            "min_duration": self.filter_min_duration,
+                            "exclude": self.filter_exclude,
+                        },
+                        "shards": {
+                            "_comment": "count > 1 crawls in that many processes, or with local false in run.py --shard i/count",
+                            "count": self.shards,
+                            "dir": self.shard_dir,
+                            "local": self.shard_local,
+                            "timeout": self.shard_timeout,
                         },
                     },
                     indent=2,
@@ -85,41 +231,275 @@ class Config:
             )
         log('Updated config.json.')
 
-
-def log(n, silent=False) -> None:
-    '''Print while logging'''
-    now = datetime.now().strftime("%d/%m/%y %H:%M:%S")
-    now = f'[{now}] '
+    def load_profile(self, path: str) -> dataclass:
+        '''A copy of this config, with the user and playlist of the profile file at `path`'''
+        with open(path, 'r') as profilefile:
+            data = json.loads(profilefile.read())
+        profile = copy.copy(self)
+        profile.profile = os.path.splitext(os.path.basename(path))[0]
+        profile.username = data['username']
+        playlist = data.get('playlist', {})
+        profile.playlist_name = playlist.get('name', self.playlist_name)
+        profile.playlist_size = playlist.get('size', self.playlist_size)
+        profile.playlist_id = playlist.get('id')
+        profile.playlist_precision = playlist.get('precision', self.playlist_precision)
+        return profile
+
+    def profiles(self) -> list:
+        '''Every profile in profiles_dir by file name, none when it isnt set'''
+        if not self.profiles_dir:
+            return []
+        paths = sorted(glob.glob(os.path.join(self.profiles_dir, '*.json')))
+        if not paths:
+            log(f'Please add a profile to {self.profiles_dir}, like {{"username": "...", "playlist": {{"name": "..."}}}}')
+            sys.exit(0)
+        return [self.load_profile(path) for path in paths]
+
+
+class Shared:
+    '''A class attribute that is made on first use, and shared by every instance from then on.
+
+    An instance can still set its own.'''
+
+    def __init__(self, factory) -> None:
+        self.factory = factory
+        self.value = None
+
+    def __get__(self, obj, cls=None):
+        if self.value is None:
+            self.value = self.factory()
+        return self.value
+
+
+def lazy(name: str):
+    '''Imports module `name` on first attribute access instead of right away'''
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    spec.loader = importlib.util.LazyLoader(spec.loader)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+DEBUG, INFO, WARNING, ERROR = 10, 20, 30, 40
+LEVELS = {'debug': DEBUG, 'info': INFO, 'warning': WARNING, 'error': ERROR}
+
+
+class Logger:
+    '''Buffers log lines in memory and appends them to the log file from a background thread.
+
+    The buffer is flushed every `interval` seconds, or as soon as it holds `size` lines, and
+    the file is rotated to recentlier.log.1, .2 .. when it grows past `max_bytes`.'''
+
+    def __init__(
+        self, path: str = 'recentlier.log', level: int = INFO, max_bytes: int = 10_000_000, backups: int = 3
+    ) -> None:
+        self.path = path
+        self.level = level
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.interval = 1.0
+        self.size = 1000
+        self.lines: list = []
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.thread = None
+        self.handle = None
+        # The timestamp only changes once a second, so it is formatted once a second.
+        self.second = None
+        self.stamp = ''
+
+    def configure(self, path: str, level: int, max_bytes: int, backups: int) -> None:
+        self.flush()
+        if path != self.path and self.handle:
+            self.handle.close()
+            self.handle = None
+        self.path, self.level, self.max_bytes, self.backups = path, level, max_bytes, backups
+
+    def enabled(self, level: int) -> bool:
+        return level >= self.level
+
+    def timestamp(self) -> str:
+        second = int(time.time())
+        if second != self.second:
+            self.second = second
+            self.stamp = datetime.fromtimestamp(second).strftime("[%d/%m/%y %H:%M:%S] ")
+        return self.stamp
+
+    def write(self, line: str) -> None:
+        with self.lock:
+            self.lines.append(line)
+            full = len(self.lines) >= self.size
+        if self.thread is None:
+            self.start()
+        if full:
+            self.wake.set()
+
+    def start(self) -> None:
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.thread = threading.Thread(target=self.run, name='logger', daemon=True)
+            self.thread.start()
+        atexit.register(self.flush)
+
+    def run(self) -> None:
+        while True:
+            self.wake.wait(self.interval)
+            self.wake.clear()
+            try:
+                self.flush()
+            except OSError as R:
+                print(f'Couldnt write to {self.path} -> Error {R}', file=sys.stderr)
+
+    def flush(self) -> None:
+        '''Writes out everything that is buffered, safe to call from any thread'''
+        with self.lock:
+            lines, self.lines = self.lines, []
+            if not lines:
+                return
+            if self.handle is None:
+                self.handle = open(self.path, 'a', encoding='utf-8', errors='replace')
+            self.handle.write(''.join(lines))
+            self.handle.flush()
+            if self.max_bytes and self.handle.tell() >= self.max_bytes:
+                self.rotate()
+
+    def rotate(self) -> None:
+        self.handle.close()
+        self.handle = None
+        if not self.backups:
+            os.remove(self.path)
+            return
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists(f'{self.path}.{i}'):
+                os.replace(f'{self.path}.{i}', f'{self.path}.{i + 1}')
+        os.replace(self.path, f'{self.path}.1')
+
+
+logger = Logger()
+
+
+def log(n, *args, silent=False, level=INFO) -> None:
+    '''Print while logging.
+
+    Lines below the configured level are dropped before anything is formatted, pass the
+    values as `args` (log('Appended %s', name, level=DEBUG)) to defer the formatting too.'''
+    if level < logger.level:
+        return
+    line = logger.timestamp() + (n % args if args else str(n))
     if not silent:
-        print(now + str(n))
-    with open('recentlier.log', 'a') as log:
-        try:
-            log.write(now + str(n) + '\n')
-        except UnicodeEncodeError:
-            log.write(now + str('UnicodeError - Unknown Track - Unkown Name (unknown Releasedate)') + '\n')
-            pass
+        print(line)
+    logger.write(line + '\n')
 
 
 class Cache:
+    '''Loads the cache once, and writes it in the background from then on.
+
+    Memory is what counts while we run. write() takes a snapshot and hands it to a single
+    cache thread, so the crawl doesnt wait for the disk, and writes asked for while one is
+    running are folded into one. changed() tells if another process wrote the cache since,
+    by the mtime and size of cache.db, or the data_version of the sqlite store.'''
+
+    path = 'cache.db'
+
     def __init__(self, obj):
         self.obj = obj
+        self.store = None
+        if obj.spot.config.cache_backend == 'sqlite':
+            self.store = SQLiteStore()
+        self.pool = ThreadPoolExecutor(1, thread_name_prefix='cache')
+        self.writing = None
+        self.dirty = False
+        # (mtime, size) of cache.db when we last read or wrote it.
+        self.stamp = None
+
+    def stat(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def snapshot(self) -> dict:
+        '''Copies the lists, so the crawl can go on changing them while they are written'''
+        return {
+            'artists': list(self.obj.Artists),
+            'albums': list(self.obj.Albums),
+            'tracks': list(self.obj.Tracks),
+            'playlist': self.obj.playlist.playlist,
+            'marks': dict(self.obj.Marks),
+            'resynced': self.obj.resynced,
+            'duplicates': self.obj.catalog.duplicates,
+            # profile name -> (Playlist, artist ids), the lists are replaced and never changed in place.
+            'profiles': {i.name: (i.playlist, i.artists) for i in self.obj.profiles if i.name},
+        }
 
     async def write(self) -> None:
-        '''pickles and dumps the data'''
-        data = [self.obj.Artists, self.obj.Albums, self.obj.Tracks, self.obj.playlist.playlist]
-        try:
-            with open('cache.db', 'wb') as handle:
-                log(f'Wrote {str(len(self.obj.Artists) + len(self.obj.Albums) + len(self.obj.Tracks))} objects to cache')
-                pickle.dump(data, handle, protocol=pickle.HIGHEST_PROTOCOL)
-        except KeyboardInterrupt:
-            log('Currently writing data to file, cant exit now.')
+        '''Writes the cache in the background, see flush()'''
+        self.dirty = True
+        if self.writing is None or self.writing.done():
+            self.writing = asyncio.ensure_future(self.persist())
+
+    async def flush(self) -> None:
+        '''Waits until everything asked to be written is on disk'''
+        if self.writing is not None:
+            await self.writing
+
+    async def persist(self) -> None:
+        while self.dirty:
+            self.dirty = False
+            with metrics.phase('cache'):
+                data = self.snapshot()
+                try:
+                    await asyncio.get_running_loop().run_in_executor(self.pool, self.dump, data)
+                except Exception as R:
+                    log(f'Couldnt write the cache -> Error {R}')
+
+    def dump(self, data: dict) -> None:
+        '''pickles and dumps the data, or writes the changed rows to the sqlite store'''
+        if self.store:
+            log(f'Wrote {str(self.store.write(data))} changed objects to cache')
+            return
+
+        # Stored as plain lists, so the cache format doesnt depend on Index.
+        pickled = [
+            data['artists'], data['albums'], data['tracks'], data['playlist'], data['marks'], data['resynced'], data['profiles'],
+            data['duplicates'],
+        ]
+        # Written next to it and moved in place, so an interrupted write leaves the old cache.
+        with open(f'{self.path}.tmp', 'wb') as handle:
+            pickle.dump(pickled, handle, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(f'{self.path}.tmp', self.path)
+        self.stamp = self.stat()
+        log(f'Wrote {str(len(data["artists"]) + len(data["albums"]) + len(data["tracks"]))} objects to cache')
+
+    async def changed(self) -> bool:
+        '''Wether another process wrote the cache since we last read or wrote it'''
+        await self.flush()
+        if self.store:
+            return self.store.changed()
+        return self.stat() != self.stamp
 
     async def load(self, main) -> None:
         '''unpickles and returns the data from cache'''
-        data = ([], [], [], [])
-        if os.path.exists('cache.db'):
+        await self.flush()
+        data = ([], [], [], [], {}, 0, {}, {})
+        if self.store and not self.store.empty():
             try:
-                with open('cache.db', 'rb') as handle:
+                data = self.store.load()
+                log(f'Cache loaded from {self.store.path}, found {str(len(data[0]) + len(data[1]) + len(data[2]))} objects')
+            except Exception as R:
+                log(f'Couldnt load data from Cache -> Error {R}')
+
+        elif os.path.exists(self.path):
+            if self.store:
+                log(f'Migrating {self.path} to {self.store.path}')
+            try:
+                self.stamp = self.stat()
+                with open(self.path, 'rb') as handle:
                     data = pickle.load(handle)
                 if len(data[0]) > 0 and len(data[1]) > 0 and len(data[2]) > 0:
                     log('Cache loaded successfully.')
@@ -134,6 +514,26 @@ class Cache:
         main.Albums = data[1]
         main.Tracks = data[2]
         main.playlist.playlist = data[3]
+        # Caches written before the incremental crawl have no marks.
+        main.Marks = data[4] if len(data) > 4 else {}
+        main.resynced = data[5] if len(data) > 5 else 0
+        profiles = data[6] if len(data) > 6 else {}
+        for profile in main.profiles:
+            if profile.name in profiles:
+                profile.playlist, profile.artists = profiles[profile.name]
+        # Caches from before have no losing duplicates, the next full resync finds them.
+        main.catalog.duplicates = data[7] if len(data) > 7 else {}
+
+    async def compact(self) -> None:
+        '''Rewrites the cache, so it doesnt keep the space of removed objects'''
+        await self.flush()
+        if self.store:
+            with metrics.phase('cache'):
+                await asyncio.get_running_loop().run_in_executor(self.pool, self.store.compact)
+            log(f'Compacted {self.store.path}')
+        else:
+            await self.write()
+            await self.flush()
 
 
 class ProgressBar:
@@ -157,64 +557,106 @@ class ProgressBar:
 
 
 class Flags:
+    '''Works out what changed since the last cycle, and with that what has to be fetched again.
+
+    Artists and albums are compared by id, and albums also by their fingerprint(). Only the
+    tracks of new and changed albums are fetched, and the tracks of removed and changed
+    albums are pruned, so a cycle where nothing changed makes no track requests.'''
+
     def __init__(self, obj):
         self.main = obj
+        self.run_albums = False
         self.run_tracks = False
         self.update_playlist = False
+        # Fetch the tracks of every album, set on a full resync.
+        self.full = False
+        self.albums = None
+        self.fetch = []
+        self.keep = []
+        # Ids of the artists followed since the tracks were last fetched.
+        self.followed = set()
+
+    @staticmethod
+    def changes(added, removed, changed=()) -> str:
+        text = ', '.join(f'{name}: {len(i)}' for name, i in (('new', added), ('removed', removed), ('changed', changed)) if i)
+        return f' ({text})' if text else ''
 
     async def check(self, what, data) -> None:
-        '''This long function determines wether or not if'''
+        '''Compares `data` to what we had, and decides what the rest of the cycle has to do'''
 
         if what == 'artists':
-            if len(data) > len(self.main.Artists):
-                log(f'Artists found: {str(len(data))} (new: {str(len(data) - len(self.main.Artists))})')
-                self.main.Artists = data
-                self.run_tracks = True
-
-            elif len(data) == len(self.main.Artists):
-                log(f'Artists found: {str(len(data))}')
-
-            elif len(data) < len(self.main.Artists):
-                len(f'Artists found: {str(len(data))} (removed: {str(len(self.main.Artists) - len(data))})')
-                self.main.Artists = data
-                self.run_tracks = True
+            added = data.ids() - self.main.Artists.ids()
+            removed = self.main.Artists.ids() - data.ids()
+            log(f'Artists found: {str(len(data))}{self.changes(added, removed)}')
+            # Albums of new and removed artists show up in the album changes.
+            self.main.Artists = data
+            # The marks of artists nobody follows anymore would keep an old filter, and make every crawl a full resync.
+            self.main.Marks = {artist_id: mark for artist_id, mark in self.main.Marks.items() if artist_id in data}
+            self.followed = (self.followed | added) - removed
+            self.run_albums = bool(added or removed)
 
         elif what == 'albums':
-            if len(data) > len(self.main.Albums):
-                log(f'Albums found: {str(len(data))} (new: {str(len(data) - len(self.main.Albums))})')
-                self.main.Albums = data
-                self.run_tracks = True
-                await self.main.cache.write()
-
-            elif len(data) == len(self.main.Albums):
+            old = self.main.Albums
+            added = [album for album in data if album.id not in old]
+            removed = {album.id for album in old if album.id not in data}
+            changed = [album for album in data if album.id in old and old[album.id].fingerprint() != album.fingerprint()]
+            # Caches written before tracks knew their album cant be pruned, so those are fetched again.
+            self.full = self.full or any(track.album_id is None for track in self.main.Tracks)
+            # Albums another artist lists can have tracks of artists we followed or unfollowed since. Those
+            # are fetched again, which credits their tracks like a full crawl would.
+            artists, marks = self.main.Artists, self.main.Marks
+            listed = {i for artist_id in self.followed for i in marks.get(artist_id, {}).get('albums', ())}
+            unfollowed = {track.album_id for track in self.main.Tracks if track.artist_id not in artists}
+            credited = {i for i in listed | unfollowed if i in old and i in data}
+            prune = removed | {album.id for album in changed} | credited
+            catalog = self.main.catalog
+            catalog.duplicates = {
+                name: [i for i in album_ids if i not in prune] for name, album_ids in catalog.duplicates.items()
+            }
+            # A track of a pruned album may have won over releases of it on other albums, which
+            # arent in Tracks. Their albums are fetched again, so the earliest of those takes its place.
+            names = {f'{track.artist_name} - {track.name}' for track in self.main.Tracks if track.album_id in prune}
+            lost = {i for name in names for i in catalog.duplicates.get(name, ())}
+            again = (credited | lost) - {album.id for album in changed}
+            again = [album for album in data if album.id in again and album.id in old]
+
+            if self.full:
+                log(f'Albums found: {str(len(data))}{self.changes(added, removed, changed)} (fetching every track)')
+                self.fetch, self.keep = data, []
+            elif added or removed or changed or again:
+                log(f'Albums found: {str(len(data))}{self.changes(added, removed, changed)}')
+                self.fetch = added + changed + again
+                self.keep = [track for track in self.main.Tracks if track.album_id not in prune]
+            else:
                 log(f'Albums found: {str(len(data))} (Nothing to update)')
+                self.main.Albums = data
                 self.run_tracks = False
+                self.followed = set()
+                return
 
-            elif len(data) < len(self.main.Albums):
-                len(f'Artists found: {str(len(data))} (removed: {str(len(self.main.Albums) - len(data))})')
-                self.main.Albums = data
-                self.run_tracks = True
-                await self.main.cache.write()
+            # The albums are kept once their tracks are in, so an interrupted crawl is redone.
+            self.albums = data
+            self.run_tracks = True
 
         elif what == 'tracks':
-            if len(data) > len(self.main.Tracks):
-                log(f'Tracks found: {str(len(data))} (new: {str(len(data) - len(self.main.Tracks))})')
-                self.main.Tracks = data
-                self.update_playlist = True
-                await self.main.cache.write()
-
-            elif len(data) == len(self.main.Tracks):
-                log(f'Tracks found: {str(len(data))}')
-
-            elif len(data) < len(self.main.Tracks):
-                len(f'Tracks found: {str(len(data))} (removed: {str(len(self.main.Tracks) - len(data))})')
-                self.main.Tracks = data
-                self.update_playlist = True
-                await self.main.cache.write()
+            added = data.ids() - self.main.Tracks.ids()
+            removed = self.main.Tracks.ids() - data.ids()
+            log(f'Tracks found: {str(len(data))}{self.changes(added, removed)}')
+            failed = self.main.catalog.failed
+            if failed:
+                # Left out, so the next crawl finds them again as new albums and fetches their tracks.
+                log(f'Couldnt fetch every track of {len(failed)} albums, they are fetched again next time.')
+            self.main.Albums = [album for album in self.albums if album.id not in failed] if failed else self.albums
+            # Even with the same ids, refetched tracks can have a new name or release date.
+            self.main.Tracks = data
+            self.run_tracks = False
+            self.followed = set()
+            self.update_playlist = True
+            await self.main.cache.write()
 
 
 class Version:
-    '''Checks for new version.'''
+    '''Checks for new version, in the background so startup doesnt wait for GitHub.'''
 
     try:
         version: float = float(open('version.txt').read())
@@ -222,20 +664,21 @@ class Version:
         version = 9999
     text = None
 
-    def __init__(self) -> None:
+    def __init__(self, check: bool = True, timeout: float = 5) -> None:
         self.text = f'Recentlier {self.version}'
+        print(self.text)
+        if check:
+            threading.Thread(target=self.check, args=(timeout,), name='version', daemon=True).start()
+
+    def check(self, timeout: float) -> None:
         try:
-            r = requests.get('https://raw.githubusercontent.com/kragebein/Recentlier2/main/version.txt')
+            r = requests.get('https://raw.githubusercontent.com/kragebein/Recentlier2/main/version.txt', timeout=timeout)
             version = r.text
             if self.version < float(version):
-                self.text += f'\n\nUpdate available: {self.version} -> {version}'
+                log(f'Update available: {self.version} -> {version}')
         except Exception:
             pass
 
-        finally:
-            print(self.text)
-            time.sleep(1)
-
 
 class RecentError(BaseException):
     pass
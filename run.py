@@ -1,8 +1,16 @@
 #!/usr/bin/python3.11
+import argparse
 import asyncio
 from recentlier.main import Recentlier
+from recentlier.shards import serve
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Keeps a playlist of the newest releases of the artists you follow.')
+    parser.add_argument('--shard', metavar='INDEX/COUNT', help='run as worker INDEX of COUNT for a coordinator elsewhere')
+    args = parser.parse_args()
 
-    sp = Recentlier()
-    asyncio.run(sp.run())
+    if args.shard:
+        serve(*map(int, args.shard.split('/')))
+    else:
+        sp = Recentlier()
+        asyncio.run(sp.run())